@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmark of the EMERALD detection stages on synthetic inputs.
+
+The inputs are built from the BGC0001472 test files: every synthetic
+contig is a copy of the BGC0001472 CDSs, repeated --cds-per-contig times,
+and every CDS keeps the InterProScan annotations of its source CDS with
+probability --density (the emerald hmm hits mirror the same signatures).
+Each size runs in a fresh process, so the peak RSS is per size.
+
+    python benchmark/bench_pipeline.py --sizes 1000 10000 100000
+    python benchmark/bench_pipeline.py --save          # store the baseline
+    python benchmark/bench_pipeline.py                 # compare with it
+
+Baselines are machine specific and are not versioned. With a baseline, the
+stage times and peak RSS higher than the baseline by more than --tolerance
+(relative) are reported and the exit status is 1.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_FILES = os.path.join(BENCH_DIR, "..", "test", "files")
+SOURCE = "BGC0001472"
+
+STAGES = [
+    "transformIPS",
+    "transformEmeraldHmm",
+    "transformCDSpredToCDScontigs",
+    "buildMatrices",
+    "predictAnn",
+    "defineLooseClusters",
+    "predictType",
+    "writeGff3",
+]
+
+# stage times below are timer noise
+MIN_SECONDS = 0.05
+
+
+def sourceCds():
+    """[(protein suffix, start, end, strand, sequence)] and {protein: IPS
+    lines} of the BGC0001472 test files"""
+
+    cdss = []
+    with open(os.path.join(TEST_FILES, f"{SOURCE}.fna.prodigal.faa")) as h:
+        for l in h:
+            if l[0] == ">":
+                spl = l[1:].split(" # ")
+                cdss.append([spl[0].split("_")[-1], int(spl[1]), int(spl[2]), spl[3], ""])
+            else:
+                cdss[-1][-1] += l.strip()
+    ips = {}
+    with open(os.path.join(TEST_FILES, f"{SOURCE}.fna.prodigal.faa.ip.tsv")) as h:
+        for l in h:
+            protein, rest = l.split("\t", 1)
+            ips.setdefault(protein.split("_")[-1], []).append(rest)
+    return cdss, ips
+
+
+def makeInputs(outdir, nContigs, cdsPerContig, density, seed=0):
+    """Write the prodigal, InterProScan and hmmscan files of nContigs
+    synthetic contigs. Returns (faa, ips, hmm, number of CDSs)"""
+
+    rng = np.random.default_rng(seed)
+    cdss, ips = sourceCds()
+    span = max(x[2] for x in cdss)
+    faa, ipsF, hmmF = (
+        os.path.join(outdir, f"synthetic_{nContigs}.{x}") for x in ["faa", "ip.tsv", "emerald.tsv"]
+    )
+    keep = rng.random(nContigs * cdsPerContig * len(cdss)) < density
+    n = 0
+    with open(faa, "w") as f, open(ipsF, "w") as i, open(hmmF, "w") as m:
+        m.write("# synthetic emerald hmm domtblout\n")
+        for c in range(nContigs):
+            ix = 0
+            for r in range(cdsPerContig):
+                for suffix, start, end, strand, seq in cdss:
+                    ix += 1
+                    protein = f"syn{c}_{ix}"
+                    f.write(
+                        f">{protein} # {start + r * span} # {end + r * span} # {strand} # ID={c}_{ix}\n{seq}\n"
+                    )
+                    if keep[n]:
+                        for l in ips.get(suffix, []):
+                            i.write(f"{protein}\t{l}")
+                            acc = l.split("\t")[3]
+                            m.write(f"{acc} - 0 {protein} - 0 1e-10 50.0 0.0 1 1 1e-10 1e-10 50.0 0.0 1 10 1 10 1 10 0.99 -\n")
+                    n += 1
+    return faa, ipsF, hmmF, n
+
+
+def peakRss():
+    """Peak resident set size of the process, MiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def runSize(nContigs, cdsPerContig, density, backend, workdir):
+    """Time every stage on nContigs synthetic contigs. Runs in a fresh
+    process"""
+
+    import emeraldbgc
+
+    sys.path.append(os.path.dirname(os.path.abspath(emeraldbgc.__file__)))
+    from modules.BGCdetection import AnnotationFilesToEmerald
+    from modules.WriteOutput import Outputs
+
+    faa, ipsF, hmmF, nCds = makeInputs(workdir, nContigs, cdsPerContig, density)
+    annotate = AnnotationFilesToEmerald(backend=backend)
+    annotate.loadModel()
+    cliArgs = argparse.Namespace(antismash_out="False", greed=1, meta="True")
+
+    steps = {
+        "transformIPS": lambda: annotate.transformIPS(ipsF),
+        "transformEmeraldHmm": lambda: annotate.transformEmeraldHmm(hmmF),
+        "transformCDSpredToCDScontigs": lambda: annotate.transformCDSpredToCDScontigs(faa, "fasta"),
+        "buildMatrices": lambda: annotate.buildMatrices(),
+        "predictAnn": lambda: annotate.predictAnn(),
+        "defineLooseClusters": lambda: annotate.defineLooseClusters(score=None, g=1),
+        "predictType": lambda: annotate.predictType(),
+        "writeGff3": lambda: Outputs(annotate, "False", cliArgs, "True", f"{faa}.gff"),
+    }
+    stages = {}
+    for stage in STAGES:
+        rss = peakRss()
+        t = time.perf_counter()
+        steps[stage]()
+        seconds = time.perf_counter() - t
+        stages[stage] = {
+            "seconds": seconds,
+            "cds_per_second": nCds / seconds if seconds else None,
+            "peak_rss_mib": peakRss(),
+            "peak_rss_delta_mib": peakRss() - rss,
+        }
+    return {
+        "contigs": nContigs,
+        "cds": nCds,
+        "clusters": sum(len(x) for x in annotate.clstIntervals.values()),
+        "peak_rss_mib": peakRss(),
+        "stages": stages,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """(size, measure, value, baseline value) of the stage times and peak
+    RSS above the baseline by more than tolerance. Stages faster than
+    MIN_SECONDS, and sizes and stages missing from the baseline are not
+    compared"""
+
+    slow = []
+    for size, res in results.items():
+        if size not in baseline:
+            continue
+        if res["peak_rss_mib"] > baseline[size]["peak_rss_mib"] * (1 + tolerance):
+            slow.append((size, "peak RSS MiB", res["peak_rss_mib"], baseline[size]["peak_rss_mib"]))
+        base = baseline[size]["stages"]
+        for stage, r in res["stages"].items():
+            if stage not in base or max(r["seconds"], base[stage]["seconds"]) < MIN_SECONDS:
+                continue
+            if r["seconds"] > base[stage]["seconds"] * (1 + tolerance):
+                slow.append((size, f"{stage} s", r["seconds"], base[stage]["seconds"]))
+    return slow
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="EMERALD detection stages benchmark")
+    parser.add_argument(
+        "--sizes",
+        dest="sizes",
+        default=[1000, 10000, 100000],
+        nargs="+",
+        type=int,
+        help="numbers of synthetic contigs [default 1000 10000 100000]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--cds-per-contig",
+        dest="cds_per_contig",
+        default=1,
+        type=int,
+        help=f"copies of the {SOURCE} CDSs per contig [default 1]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--density",
+        dest="density",
+        default=1.0,
+        type=float,
+        help="probability of a CDS keeping its annotations [default 1.0]",
+        metavar="FLOAT",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="keras",
+        type=str,
+        help="BGC model inference backend [default keras]",
+        metavar="keras|onnx|tflite",
+    )
+    parser.add_argument(
+        "--baseline",
+        dest="baseline",
+        default=os.path.join(BENCH_DIR, "baseline.json"),
+        type=str,
+        help="baseline file [default benchmark/baseline.json]",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--save",
+        dest="save",
+        action="store_true",
+        help="store the results as the baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        default=0.2,
+        type=float,
+        help="relative slowdown reported as a regression [default 0.2]",
+        metavar="FLOAT",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        default=None,
+        type=str,
+        help="Optional, write the results JSON",
+        metavar="FILE",
+    )
+    args = parser.parse_args(args)
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                res = pool.submit(
+                    runSize, size, args.cds_per_contig, args.density, args.backend, workdir
+                ).result()
+            results[str(size)] = res
+            print(
+                f"{size} contigs, {res['cds']} CDS, {res['clusters']} clusters, peak RSS {res['peak_rss_mib']:.0f} MiB"
+            )
+            for stage, r in res["stages"].items():
+                print(
+                    f"  {stage:<30} {r['seconds']:>9.3f} s {r['cds_per_second'] or 0:>12.0f} CDS/s {r['peak_rss_delta_mib']:>+8.1f} MiB"
+                )
+
+    if args.output:
+        with open(args.output, "w") as h:
+            json.dump(results, h, indent=1)
+
+    if args.save:
+        with open(args.baseline, "w") as h:
+            json.dump(results, h, indent=1)
+        print(f"baseline saved in {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as h:
+            slow = regressions(results, json.load(h), args.tolerance)
+        for size, measure, value, base in slow:
+            print(f"REGRESSION {size} contigs {measure}: {value:.3f}, baseline {base:.3f}")
+        if slow:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -19,17 +19,34 @@ import logging
 import os
 import sys
 import warnings
+from contextlib import nullcontext
 
-from emeraldbgc import __version__
+from emeraldbgc import __version__, _params
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from modules.BGCdetection import AnnotationFilesToEmerald
-from modules.Preproc import Preprocess
-from modules.WriteOutput import Outputs
+from modules.Inference import MODEL_FILES
+from modules.StageMarkers import RESUMABLE
 
+log = logging.getLogger("EMERALD")
+
+# command line options used by the detection step
+DETECT_ARGS = [
+    "score", "greed", "minimal_out", "antismash_out", "ref_b", "meta", "batch_size",
+    "chunk_size", "checkpoint",
+]
+
+# stages measured in the run report, and profiled with --profile STAGE
+STAGES = [
+    "prodigal", "gbk_to_faa", "interproscan", "hmmscan", "server",
+    "transformIPS", "transformEmeraldHmm", "transformCDSpredToCDScontigs",
+    "buildMatrices", "predictAnn", "defineLooseClusters", "predictType",
+    "writeOutput", "checkpoint",
+]
 
-def main(args=None):
+
+def argParser():
+    """emeraldbgc command line parser"""
 
     parser = argparse.ArgumentParser(description="EMERALD. SMBGC detection tool")
     parser.add_argument(
@@ -124,8 +141,101 @@ def main(args=None):
         help="cpus for INTERPROSCAN and HMMSCAN",
         metavar="INT",
     )
+    parser.add_argument(
+        "--hmmsearch",
+        dest="hmmsearch",
+        default="False",
+        type=str,
+        help="annotate the emerald hmm library with hmmsearch instead of hmmscan, faster when proteins greatly outnumber profiles [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=None,
+        type=str,
+        help="Optional, SQLite file caching the InterProScan and hmm annotations of every protein sequence across runs. Only unseen sequences are annotated",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        default=None,
+        type=int,
+        help=f"windows of {_params['shape']} CDS per inference batch, across contigs [default {_params['batch_size']}]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        default="False",
+        type=str,
+        help="save the per-CDS probabilities, CDS and annotation matrices in OUTFILE.checkpoint.npz, to rescore other thresholds with emerald_rescore [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        default=None,
+        type=int,
+        help="Optional, stream the detection in chunks of INT contigs. Each chunk is predicted, classified and appended to the output before the next, keeping memory bounded on large assemblies. Same output as a full run",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="keras",
+        type=str,
+        choices=list(MODEL_FILES),
+        help="BGC model inference backend. keras (TensorFlow), onnx (onnxruntime) or tflite. onnx and tflite models are built with emerald_export_model [default keras]",
+        metavar="keras|onnx|tflite",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        default="False",
+        type=str,
+        help="skip the stages completed by a previous run in the same outdir, whose inputs, tool and model versions did not change. The BGC prediction is resumed from the --checkpoint True probabilities. Stage markers are written by --resume True runs only, as they cost an md5 of the stage inputs and a tool version call per stage (a JVM start for InterProScan) [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--force-stage",
+        dest="force_stage",
+        default=[],
+        action="append",
+        choices=RESUMABLE,
+        help=f"Optional, re-run this stage with --resume True, even when up to date. Repeat for several stages. {', '.join(RESUMABLE)}",
+        metavar="STAGE",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=None,
+        type=str,
+        help="Optional, profile the whole run (all) or only STAGE, e.g. predictType, with cProfile and stack sampling, writing OUTDIR/emerald.profile.STAGE.pstats and a collapsed-stack file (flamegraph.pl, speedscope)",
+        metavar="all|STAGE",
+    )
+    parser.add_argument(
+        "--server",
+        dest="server",
+        default=None,
+        type=str,
+        help="Optional, unix socket of a running emerald_server. Preprocessing runs locally and the detection is submitted to the server, which keeps the models loaded",
+        metavar="SOCKET",
+    )
+    return parser
+
 
+def main(args=None):
+
+    parser = argParser()
     args = parser.parse_args(args)
+    if args.profile and args.profile not in STAGES + ["all"]:
+        parser.error(f"--profile: unknown stage {args.profile}, one of {', '.join(STAGES)}")
+
+    from modules.Profiler import Profiler
+    from modules.RunReport import RunReport
+    from modules.StageMarkers import StageMarkers
 
     basef = args.seq_file
     base = os.path.basename(basef)
@@ -141,7 +251,6 @@ def main(args=None):
     )
     logging.captureWarnings(True)
     print(f"LOG_FILE: {outdir}/emerald.log")
-    log = logging.getLogger("EMERALD")
     log.info(
         f"""
     ******
@@ -149,6 +258,30 @@ def main(args=None):
     ******"""
     )
     log.info(f"outdir: {outdir}")
+    profiler = (
+        Profiler(f"{outdir}/emerald.profile.{args.profile}", args.profile)
+        if args.profile
+        else None
+    )
+    report = RunReport(f"{outdir}/emerald.report.json", vars(args), profiler)
+    markers = StageMarkers(outdir, args.resume == "True", args.force_stage)
+    try:
+        with profiler.scope() if profiler else nullcontext():
+            run(args, outdir, base, report, markers)
+    finally:
+        report.write()
+        if profiler:
+            profiler.write()
+
+    log.info("EMERALD succesful")
+    print("EMERALD succesful")
+
+
+def run(args, outdir, base, report, markers):
+    """Preprocessing, then the detection locally or on an emerald_server.
+    The preprocessing stages and the local detection are resumable with
+    markers (StageMarkers)"""
+    from modules.Preproc import Preprocess
 
     log.info("preprocessing files")
     preprocess = Preprocess(
@@ -156,50 +289,182 @@ def main(args=None):
             args.ip_file, 
             args.meta, 
             args.cpu, 
-            outdir
+            outdir,
+            hmmsearch=args.hmmsearch,
+            cache=args.cache,
+            report=report,
+            markers=markers,
     )
    
 
     prodigal_file, ips_file, hmm_file = preprocess.process_sequence()
 
-    log.info("EMERALD process")
-    annotate = AnnotationFilesToEmerald()
+    cds_file, cds_fmt = (
+        (prodigal_file, "fasta")
+        if preprocess.fmt == "fasta"
+        else (preprocess.cdsTable, "cds_table")
+    )
+    outfile = args.outfile if args.outfile else f"{outdir}/{base}.emerald.full.gff"
+
+    if args.server:
+        log.info(f"submit to EMERALD server {args.server}")
+        from emeraldbgc.server import submit
+
+        with report.stage("server"):
+            submit(
+                args.server,
+                {
+                    "ips_file": os.path.abspath(ips_file),
+                    "hmm_file": os.path.abspath(hmm_file),
+                    "cds_file": os.path.abspath(cds_file),
+                    "fmt": cds_fmt,
+                    "outfile": os.path.abspath(outfile),
+                    "args": {k: getattr(args, k) for k in DETECT_ARGS},
+                },
+            )
+    else:
+        log.info("EMERALD process")
+        from modules.BGCdetection import AnnotationFilesToEmerald
+
+        annotate = AnnotationFilesToEmerald(backend=args.backend)
+        detect(annotate, ips_file, hmm_file, cds_file, cds_fmt, args, outfile, report, markers)
+
+
+def detect(annotate, ips_file, hmm_file, cds_file, fmt, args, outfile, report=None, markers=None):
+    """EMERALD detection on preprocessed annotation files. annotate keeps
+    the loaded models and is reset before use. The stages are measured in
+    report (RunReport).
+
+    With markers (StageMarkers) and --checkpoint True, the checkpoint is
+    the output of the resumable predictAnn stage. When it is up to date
+    the clusters are called from the saved probabilities"""
+    from modules.BGCdetection import POST_FILTERS
+    from modules.Inference import modelFile
+    from modules.RunReport import RunReport
+    from modules.WriteOutput import Outputs
+
+    report = report if report else RunReport()
+    annotate.reset()
+
+    checkpointFile = f"{outfile}.checkpoint.npz"
+    stage = (
+        "predictAnn",
+        [ips_file, hmm_file, cds_file, modelFile(annotate.backend), POST_FILTERS],
+        {"fmt": fmt, "backend": annotate.backend, "shape": _params["shape"]},
+        [checkpointFile],
+    )
+    resumable = markers is not None and markers.resume and args.checkpoint == "True"
+    if resumable and markers.current(*stage):
+        with report.stage("checkpoint"):
+            annotate.loadCheckpoint(checkpointFile)
+        clusterContigs(annotate, args, report=report)
+        with report.stage("writeOutput") as counts:
+            outputs = Outputs(annotate, args.minimal_out, args, args.ref_b, outfile)
+            counts["contigs"] = len(annotate.contigsDct)
+        return outputs
+    if markers is not None:
+        markers.start("predictAnn")
 
     log.info("transform interpro file")
-    annotate.transformIPS(ips_file)
+    with report.stage("transformIPS") as counts:
+        annotate.transformIPS(ips_file)
+        counts["annotated_proteins"] = len(annotate.entriesDct)
 
     log.info("transform inhouse hmm file")
-    annotate.transformEmeraldHmm(hmm_file)
+    with report.stage("transformEmeraldHmm") as counts:
+        annotate.transformEmeraldHmm(hmm_file)
+        counts["annotated_proteins"] = len(annotate.entriesDct)
 
     log.info("transform proteins file")
-    annotate.transformCDSpredToCDScontigs(
-            prodigal_file if preprocess.fmt == "fasta" else args.seq_file,
-            preprocess.fmt)
-    
+    with report.stage("transformCDSpredToCDScontigs") as counts:
+        annotate.transformCDSpredToCDScontigs(cds_file, fmt)
+        counts["contigs"] = len(annotate.contigsDct)
+        counts["cds"] = sum(len(x) for x in annotate.contigsDct.values())
+
+    checkpoint = []
+    if args.chunk_size:
+        log.info(f"stream detection in chunks of {args.chunk_size} contigs")
+        outputs = Outputs(annotate, args.minimal_out, args, args.ref_b, outfile, stream=True)
+        contigs = sorted(annotate.contigsDct)
+        for i in range(0, len(contigs), args.chunk_size):
+            chunk = contigs[i : i + args.chunk_size]
+            log.info(f"contigs {i + 1}-{i + len(chunk)} of {len(contigs)}")
+            detectContigs(annotate, args, chunk, report)
+            with report.stage("writeOutput") as counts:
+                outputs.writeContigs(chunk)
+                counts["contigs"] = len(chunk)
+            if args.checkpoint == "True":
+                with report.stage("checkpoint"):
+                    checkpoint.append(
+                        annotate.saveCheckpointPart(f"{checkpointFile}.part{len(checkpoint)}.npz", chunk)
+                    )
+            annotate.releaseContigs(chunk)
+        with report.stage("writeOutput"):
+            outputs.close()
+    else:
+        detectContigs(annotate, args, report=report)
+        if args.checkpoint == "True":
+            with report.stage("checkpoint"):
+                checkpoint.append(annotate.saveCheckpointPart(f"{checkpointFile}.part0.npz"))
+
+        log.info("write output file file")
+        with report.stage("writeOutput") as counts:
+            outputs = Outputs(
+                annotate,
+                args.minimal_out,
+                args,
+                args.ref_b,
+                outfile,
+            )
+            counts["contigs"] = len(annotate.contigsDct)
+
+    if checkpoint:
+        with report.stage("checkpoint"):
+            annotate.saveCheckpoint(checkpointFile, checkpoint, args.meta)
+        if resumable:
+            markers.done(*stage)
+    return outputs
+
+
+def detectContigs(annotate, args, contigs=None, report=None):
+    """BGC prediction, clusters and type classification of contigs (all
+    the contigs when None)"""
+    from modules.RunReport import RunReport
+
+    report = report if report else RunReport()
+    names = list(annotate.contigsDct) if contigs is None else contigs
+
     log.info("transform dicts to np matrices")
-    annotate.buildMatrices()
+    with report.stage("buildMatrices") as counts:
+        annotate.buildMatrices(contigs)
+        counts["contigs"] = len(names)
 
     log.info("predict bgc regions")
-    annotate.predictAnn()
+    with report.stage("predictAnn") as counts:
+        annotate.predictAnn(batchSize=args.batch_size)
+        counts["cds"] = sum(len(annotate.contigsDct[x]) for x in names)
+
+    clusterContigs(annotate, args, contigs, report)
+
+
+def clusterContigs(annotate, args, contigs=None, report=None):
+    """Clusters and type classification of the predicted contigs (all the
+    contigs when None)"""
+    from modules.RunReport import RunReport
+
+    report = report if report else RunReport()
+    names = list(annotate.contigsDct) if contigs is None else contigs
 
     log.info("define clusters")
     log.info(f"score: {args.score} greed: {args.greed}")
-    annotate.defineLooseClusters(score=args.score, g=args.greed)
+    with report.stage("defineLooseClusters") as counts:
+        annotate.defineLooseClusters(score=args.score, g=args.greed)
+        counts["clusters"] = sum(len(annotate.clstIntervals[x]) for x in names)
 
     log.info("post-processing filters and type classification")
-    annotate.predictType()
-
-    log.info("write output file file")
-    outp = Outputs(
-        annotate,
-        args.minimal_out,
-        args,
-        args.ref_b,
-        args.outfile if args.outfile else f"{outdir}/{base}.emerald.full.gff",
-    )
-
-    log.info("EMERALD succesful")
-    print("EMERALD succesful")
+    with report.stage("predictType") as counts:
+        annotate.predictType()
+        counts["typed_clusters"] = sum(len(annotate.clstTypes[x]) for x in names)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" EMERALD over many genomes in one process.
+
+Genomes are processed in groups. In every group the CDS prediction runs in
+a pool of --cpu workers, the proteins of all the genomes are concatenated
+with a per-genome id prefix so InterProScan and hmmscan run once on the
+group, and their outputs are split back per genome. The detection models
+are loaded once and every genome gets its own outdir/SEQUENCE_FILE.emerald
+directory, with the same files as a single emeraldbgc run. The emerald.log
+and emerald.report.json of a genome cover its CDS prediction and detection;
+the InterProScan and hmmscan runs shared by the group are logged in
+outdir/emerald_batch.log.
+"""
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from emeraldbgc import __version__, _params
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from emeraldbgc._cli import detect
+from modules.Inference import MODEL_FILES
+
+log = logging.getLogger("EMERALD.batch")
+
+GENOME_ID = re.compile(r"g(\d+)_")
+
+
+def resolveInputs(patterns, manifest):
+    """Sequence files from glob patterns and a manifest with one path per
+    line. Manifest paths are relative to the manifest directory"""
+
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            log.warning(f"{pattern} matches no file")
+        paths.extend(matches)
+    if manifest:
+        root = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r") as h:
+            for l in h:
+                l = l.strip()
+                if l and l[0] != "#":
+                    paths.append(os.path.join(root, l))
+
+    paths = list(dict.fromkeys(os.path.abspath(x) for x in paths))
+    bases = [os.path.basename(x) for x in paths]
+    dups = sorted({x for x in bases if bases.count(x) > 1})
+    if dups:
+        raise SystemExit(f"sequence files with the same name: {', '.join(dups)}")
+    return paths
+
+
+@contextmanager
+def genomeLog(outdir):
+    """Copy the log records of the with block to outdir/emerald.log"""
+
+    handler = logging.FileHandler(f"{outdir}/emerald.log")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.DEBUG)
+    root.addHandler(handler)
+    try:
+        yield
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+        handler.close()
+
+
+def predictCds(seq_file, meta, outdir):
+    """CDS prediction of one genome, returns ((faa, CDS file, CDS file
+    format), the RunReport stages of the prediction)"""
+    from modules.Preproc import Preprocess
+    from modules.RunReport import RunReport
+
+    os.makedirs(outdir, exist_ok=True)
+    report = RunReport()
+    with genomeLog(outdir):
+        log.info(f"EMERALD v{__version__} batch, {seq_file}")
+        preprocess = Preprocess(seq_file, None, meta, 1, outdir, report=report)
+        preprocess.check_fmt()
+        if preprocess.fmt == "fasta":
+            faa = preprocess.timed("prodigal", preprocess.runProdigal)
+            return (faa, faa, "fasta"), report.stages
+        faa = preprocess.timed("gbk_to_faa", preprocess.gbkToProdigal)
+        return (faa, preprocess.cdsTable, "cds_table"), report.stages
+
+
+def joinProteins(faas, outFaa):
+    """Concatenate protein files, prefixing the ids with the genome index"""
+
+    with open(outFaa, "w") as h:
+        for i, faa in faas:
+            with open(faa, "r") as hf:
+                for l in hf:
+                    h.write(f">g{i}_{l[1:]}" if l[0] == ">" else l)
+
+
+def splitAnnotation(annFile, outFiles, sep, idCol):
+    """Split a concatenated annotation file in the per-genome outFiles,
+    removing the genome id prefix. sep None for whitespace separated"""
+
+    handles = {i: open(f, "w") for i, f in outFiles.items()}
+    try:
+        with open(annFile, "r") as h:
+            for l in h:
+                if l[0] == "#" or not l.strip():
+                    continue
+                spl = l.rstrip("\n").split(sep, 22 if sep is None else -1)
+                m = GENOME_ID.match(spl[idCol])
+                spl[idCol] = spl[idCol][m.end() :]
+                handles[int(m.group(1))].write(
+                    ("\t" if sep else " ").join(spl) + "\n"
+                )
+    finally:
+        for h in handles.values():
+            h.close()
+
+
+def runGroup(annotate, genomes, args, batchDir):
+    """Preprocess and detect a group of (index, seq_file) genomes. Returns
+    the list of failed sequence files"""
+    from modules.Preproc import Preprocess
+    from modules.RunReport import RunReport
+
+    failed, cds, stages = [], {}, {}
+    # spawned workers, the parent may hold the inference runtime
+    with ProcessPoolExecutor(
+        max(1, min(args.cpu, len(genomes))), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            i: executor.submit(predictCds, seq_file, args.meta, genomeDir(args, seq_file))
+            for i, seq_file in genomes
+        }
+        for i, seq_file in genomes:
+            try:
+                cds[i], stages[i] = futures[i].result()
+            except (Exception, SystemExit) as err:
+                log.error(f"{seq_file} CDS prediction failed: {err}")
+                failed.append(seq_file)
+    if not cds:
+        return failed
+
+    seqFiles = dict(genomes)
+    faa = os.path.join(batchDir, "batch.faa")
+    joinProteins([(i, cds[i][0]) for i in cds], faa)
+
+    log.info(f"annotate proteins of {len(cds)} genomes")
+    preprocess = Preprocess(
+        faa, None, args.meta, args.cpu, batchDir, hmmsearch=args.hmmsearch, cache=args.cache
+    )
+    preprocess.outFaa = faa
+    ips_file, hmm_file = preprocess.annotateProteins()
+
+    splitAnnotation(
+        ips_file,
+        {i: os.path.join(genomeDir(args, seqFiles[i]), f"{os.path.basename(cds[i][0])}.ip.tsv") for i in cds},
+        "\t",
+        0,
+    )
+    splitAnnotation(
+        hmm_file,
+        {i: os.path.join(genomeDir(args, seqFiles[i]), f"{os.path.basename(cds[i][0])}.emerald.tsv") for i in cds},
+        None,
+        3,
+    )
+    for f in (faa, ips_file, hmm_file):
+        os.remove(f)
+
+    for i, (prodigal_file, cds_file, cds_fmt) in cds.items():
+        seq_file, outdir = seqFiles[i], genomeDir(args, seqFiles[i])
+        base = os.path.basename(seq_file)
+        report = RunReport(f"{outdir}/emerald.report.json", vars(args))
+        report.stages.update(stages[i])
+        with genomeLog(outdir):
+            log.info(f"EMERALD process {base}")
+            try:
+                detect(
+                    annotate,
+                    os.path.join(outdir, f"{os.path.basename(prodigal_file)}.ip.tsv"),
+                    os.path.join(outdir, f"{os.path.basename(prodigal_file)}.emerald.tsv"),
+                    cds_file,
+                    cds_fmt,
+                    args,
+                    f"{outdir}/{base}.emerald.full.gff",
+                    report,
+                )
+                report.write()
+            except Exception as err:
+                log.exception(f"{seq_file} detection failed: {err}")
+                failed.append(seq_file)
+    return failed
+
+
+def genomeDir(args, seq_file):
+    return os.path.join(args.outdir, f"{os.path.basename(seq_file)}.emerald")
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(
+        description="emerald_batch. EMERALD SMBGC detection over many sequence files"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        type=str,
+        help="input nucleotide sequence files or glob patterns. FASTA or GBK",
+        metavar="SEQUENCE_FILE",
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        help="Show the version number and exit.",
+        version=f"EMERALD {__version__}",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        default=None,
+        type=str,
+        help="file with one sequence file path per line",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--group-size",
+        dest="group_size",
+        default=500,
+        type=int,
+        help="genomes annotated together by InterProScan and hmmscan [default 500]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--greed",
+        dest="greed",
+        default=1,
+        type=int,
+        help="Level of greediness. 0,1,2 [default 1]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--score",
+        dest="score",
+        default=None,
+        type=float,
+        help="validation filter threshold. overrides --greed",
+        metavar="FLOAT",
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        default="True",
+        type=str,
+        help="prodigal option meta [default True]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--outdir",
+        default=os.getcwd(),
+        dest="outdir",
+        type=str,
+        help="output directory, one SEQUENCE_FILE.emerald subdirectory per genome [default $PWD]",
+        metavar="DIRECTORY",
+    )
+    parser.add_argument(
+        "--minimal",
+        dest="minimal_out",
+        default="True",
+        type=str,
+        help="minimal output in a gff3 file [default True]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--antismash_output",
+        dest="antismash_out",
+        default="False",
+        type=str,
+        help="write results in antiSMASH 6.0 JSON specification output [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--refined",
+        dest="ref_b",
+        default="False",
+        type=str,
+        help="annotate high probability borders [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--cpu",
+        dest="cpu",
+        default=1,
+        type=int,
+        help="CDS prediction workers and cpus for INTERPROSCAN and HMMSCAN",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--hmmsearch",
+        dest="hmmsearch",
+        default="False",
+        type=str,
+        help="annotate the emerald hmm library with hmmsearch instead of hmmscan [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=None,
+        type=str,
+        help="Optional, SQLite file caching the InterProScan and hmm annotations of every protein sequence across runs",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        default=None,
+        type=int,
+        help=f"windows of {_params['shape']} CDS per inference batch [default {_params['batch_size']}]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        default="False",
+        type=str,
+        help="save the per-CDS probabilities, CDS and annotation matrices in OUTFILE.checkpoint.npz, to rescore other thresholds with emerald_rescore [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        default=None,
+        type=int,
+        help="Optional, stream the detection in chunks of INT contigs. Each chunk is predicted, classified and appended to the output before the next, keeping memory bounded on large assemblies. Same output as a full run",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="keras",
+        type=str,
+        choices=list(MODEL_FILES),
+        help="BGC model inference backend. keras (TensorFlow), onnx (onnxruntime) or tflite. onnx and tflite models are built with emerald_export_model [default keras]",
+        metavar="keras|onnx|tflite",
+    )
+
+    args = parser.parse_args(args)
+
+    seqFiles = resolveInputs(args.inputs, args.manifest)
+    if not seqFiles:
+        parser.error("no sequence files, give SEQUENCE_FILE or --manifest")
+
+    args.outdir = os.path.abspath(args.outdir)
+    os.makedirs(args.outdir, exist_ok=True)
+
+    logging.basicConfig(
+        filename=f"{args.outdir}/emerald_batch.log",
+        level=logging.DEBUG,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    logging.captureWarnings(True)
+    print(f"LOG_FILE: {args.outdir}/emerald_batch.log")
+    log.info(
+        f"""
+    ******
+    EMERALD v{__version__} batch
+    ******"""
+    )
+    log.info(f"{len(seqFiles)} sequence files, outdir: {args.outdir}")
+
+    log.info("loading models")
+    from modules.BGCdetection import AnnotationFilesToEmerald
+
+    annotate = AnnotationFilesToEmerald(backend=args.backend)
+    annotate.loadModel()
+
+    batchDir = os.path.join(args.outdir, "emerald_batch")
+    os.makedirs(batchDir, exist_ok=True)
+
+    failed = []
+    genomes = list(enumerate(seqFiles))
+    for g in range(0, len(genomes), args.group_size):
+        group = genomes[g : g + args.group_size]
+        log.info(f"genomes {g + 1}-{g + len(group)} of {len(genomes)}")
+        failed.extend(runGroup(annotate, group, args, batchDir))
+    shutil.rmtree(batchDir, ignore_errors=True)
+
+    if failed:
+        log.error(f"{len(failed)} sequence files failed: {' '.join(failed)}")
+        raise SystemExit(f"EMERALD failed on {len(failed)} of {len(seqFiles)} sequence files, see the log")
+
+    log.info("EMERALD succesful")
+    print("EMERALD succesful")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
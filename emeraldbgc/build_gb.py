@@ -17,7 +17,6 @@ import argparse
 import sys
 import glob
 import os
-from Bio import SeqIO
 
 def main(args=None):
 
@@ -52,6 +51,8 @@ def main(args=None):
     
     args = parser.parse_args(args)
 
+    from Bio import SeqIO
+
     fna = {rec.id:rec.seq for rec in SeqIO.parse(open(args.nuc_f),'fasta')}
     faa = list(SeqIO.parse(open(args.pro_f),'fasta'))
 
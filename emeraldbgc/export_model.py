@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Convert the keras BGC model to the lightweight inference backends.
+
+Requires TensorFlow, and tf2onnx for the onnx format. The converted models
+are written next to emerald.h5, where emeraldbgc --backend finds them.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from emeraldbgc import _params
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def exportOnnx(model, outFile, opset):
+    import tensorflow as tf
+    import tf2onnx
+
+    spec = (
+        tf.TensorSpec(
+            (None,) + tuple(model.inputs[0].shape[1:]),
+            model.inputs[0].dtype,
+            name="windows",
+        ),
+    )
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=outFile)
+
+
+def exportTflite(model, outFile):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(outFile, "wb") as h:
+        h.write(converter.convert())
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(
+        description="emerald_export_model. Convert the EMERALD keras model to ONNX or TFLite"
+    )
+    parser.add_argument(
+        "--format",
+        dest="formats",
+        default=["onnx", "tflite"],
+        nargs="+",
+        choices=["onnx", "tflite"],
+        help="output formats [default onnx tflite]",
+    )
+    parser.add_argument(
+        "--opset",
+        dest="opset",
+        default=13,
+        type=int,
+        help="ONNX opset [default 13]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--check",
+        dest="check",
+        default="True",
+        type=str,
+        help="compare the converted and keras outputs on random windows [default True]",
+        metavar="True|False",
+    )
+    args = parser.parse_args(args)
+
+    from modules.BGCdetection import AnnotationFilesToEmerald
+    from modules.Inference import KerasModel, loadBackend, modelFile
+
+    keras = KerasModel(modelFile("keras"))
+    for fmt in args.formats:
+        outFile = modelFile(fmt)
+        print(f"export {fmt}: {outFile}")
+        if fmt == "onnx":
+            exportOnnx(keras.model, outFile, args.opset)
+        else:
+            exportTflite(keras.model, outFile)
+
+        if args.check == "True":
+            x = np.random.default_rng(0).integers(
+                0, len(AnnotationFilesToEmerald().vocab), size=(64, _params["shape"])
+            )
+            diff = np.abs(
+                loadBackend(fmt).predict(x, batch_size=16).reshape(-1)
+                - keras.predict(x, batch_size=16).reshape(-1)
+            ).max()
+            print(f"{fmt} max abs difference to keras: {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
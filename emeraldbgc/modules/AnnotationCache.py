@@ -0,0 +1,168 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from itertools import groupby, islice
+
+log = logging.getLogger(f"EMERALD.{__name__}")
+
+
+def chunked(iterable, n):
+    """Iterate lists of up to n items of iterable"""
+
+    it = iter(iterable)
+    while True:
+        items = list(islice(it, n))
+        if not items:
+            return
+        yield items
+
+
+class AnnotationCache:
+    """Content-addressed SQLite cache of per-protein annotation lines.
+
+    Entries are keyed by the tool/model version and the sha256 of the
+    protein sequence. The cached lines keep every column but the protein
+    id, so they can be re-attached to any protein with the same sequence"""
+
+    def __init__(self, dbFile):
+
+        self.dbFile = os.path.abspath(dbFile)
+        with closing(self.connect()) as con, con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS annotation "
+                "(tool TEXT, seqhash TEXT, lines TEXT, PRIMARY KEY (tool, seqhash))"
+            )
+
+    def connect(self):
+        return sqlite3.connect(self.dbFile, timeout=600)
+
+    def get(self, tool, hashes, chunk=500):
+        """Cached lines of the hashes found for tool"""
+
+        with closing(self.connect()) as con:
+            return dict(self.lookup(con, tool, hashes, chunk=chunk))
+
+    def lookup(self, con, tool, hashes, columns="seqhash, lines", chunk=500):
+        """Iterate the columns of the cached hashes of tool"""
+
+        hashes = list(hashes)
+        for i in range(0, len(hashes), chunk):
+            sub = hashes[i : i + chunk]
+            yield from con.execute(
+                "SELECT {} FROM annotation WHERE tool = ? AND seqhash IN ({})".format(
+                    columns, ",".join("?" * len(sub))
+                ),
+                [tool] + sub,
+            )
+
+    def put(self, tool, entries):
+        """Store a {seqhash: lines} dict for tool"""
+
+        with closing(self.connect()) as con, con:
+            con.executemany(
+                "INSERT OR REPLACE INTO annotation VALUES (?, ?, ?)",
+                [(tool, k, v) for k, v in entries.items()],
+            )
+
+    def annotate(self, tool, faa, outFile, run, sep, idCol, workFaa, chunk=500):
+        """Write in outFile the tool output for the proteins in faa, running
+        run(faa, outFile) only on the sequences missing from the cache.
+
+        sep and idCol describe the column layout of the output lines (sep
+        None for whitespace separated). workFaa is the FASTA file where the
+        uncached proteins are written. The proteins and the new tool output
+        go through the cache in chunks of chunk proteins or lines, with the
+        uncached proteins and their hits in temporary tables, so the memory
+        use does not grow with the number of proteins"""
+
+        with closing(self.connect()) as con:
+            con.execute("CREATE TEMP TABLE pending (seqhash TEXT PRIMARY KEY, pid TEXT)")
+            con.execute("CREATE TEMP TABLE hits (pid TEXT, line TEXT)")
+
+            nProteins = nCached = nNew = 0
+            with open(workFaa, "w") as h:
+                for proteins in chunked(self.hashFasta(faa), chunk):
+                    found = {x[0] for x in self.lookup(con, tool, {x[1] for x in proteins}, "seqhash")}
+                    for pid, seqhash, seq in proteins:
+                        if seqhash in found:
+                            nCached += 1
+                        elif con.execute(
+                            "INSERT OR IGNORE INTO pending VALUES (?, ?)", (seqhash, pid)
+                        ).rowcount:
+                            h.write(f">{pid}\n{seq}\n")
+                            nNew += 1
+                    nProteins += len(proteins)
+                    con.commit()
+            log.info(f"{tool} cache: {nCached} of {nProteins} proteins found")
+
+            if nNew:
+                newOut = f"{workFaa}.out"
+                run(workFaa, newOut)
+                with open(newOut, "r") as h:
+                    for lines in chunked((l for l in h if l[0] != "#" and l.strip()), chunk):
+                        rows = []
+                        for l in lines:
+                            spl = l.rstrip("\n").split(sep, 22 if sep is None else -1)
+                            pid = spl.pop(idCol)
+                            rows.append((pid, "\t".join(spl)))
+                        con.executemany("INSERT INTO hits VALUES (?, ?)", rows)
+                con.execute("CREATE INDEX temp.hits_pid ON hits (pid)")
+                con.commit()
+
+                # the lines of every new protein, none when without hits
+                entries = con.execute(
+                    "SELECT p.seqhash, h.line FROM pending p LEFT JOIN hits h ON h.pid = p.pid "
+                    "ORDER BY p.seqhash, h.rowid"
+                )
+                with con:
+                    groups = (
+                        (tool, k, "\n".join(x[1] for x in g if x[1] is not None))
+                        for k, g in groupby(entries, key=lambda x: x[0])
+                    )
+                    for rows in chunked(groups, chunk):
+                        con.executemany("INSERT OR REPLACE INTO annotation VALUES (?, ?, ?)", rows)
+                os.remove(newOut)
+
+            os.remove(workFaa)
+            with open(outFile, "w") as h:
+                for proteins in chunked(self.hashFasta(faa), chunk):
+                    cached = dict(self.lookup(con, tool, {x[1] for x in proteins}))
+                    for pid, seqhash, seq in proteins:
+                        for l in cached[seqhash].split("\n") if cached[seqhash] else []:
+                            spl = l.split("\t")
+                            spl.insert(idCol, pid)
+                            h.write(("\t" if sep else " ").join(spl) + "\n")
+
+        return os.path.abspath(outFile)
+
+    def hashFasta(self, faa):
+        """Iterate (id, sha256 of the sequence, sequence) of a FASTA file"""
+
+        pid, seq = None, []
+        with open(faa, "r") as h:
+            for l in h:
+                if l[0] == ">":
+                    if pid is not None:
+                        s = "".join(seq)
+                        yield pid, hashlib.sha256(s.encode()).hexdigest(), s
+                    pid, seq = l[1:].split()[0], []
+                else:
+                    seq.append(l.strip())
+        if pid is not None:
+            s = "".join(seq)
+            yield pid, hashlib.sha256(s.encode()).hexdigest(), s
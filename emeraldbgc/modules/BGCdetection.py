@@ -16,62 +16,214 @@ import logging
 import os
 import re
 import pickle
-from itertools import groupby
+import zipfile
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from sys import intern
 
 import numpy as np
+from scipy import sparse
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
-import tensorflow as tf
-from joblib import load
 
 from emeraldbgc import __version__, _params
+from modules.Inference import loadBackend
 
 log = logging.getLogger(f"EMERALD.{__name__}")
 
+IPS_GFF_IPR = re.compile("InterPro:|\"")
+IPS_GFF_NAME = re.compile("Name=|;")
+EMPTY_ENTRIES = array("i")
+TYPE_ATTRS = "nearest_MiBIG={};nearest_MiBIG_class={};nearest_MiBIG_diceDistance={:.3f};score={:.3f}"
+POST_FILTERS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "models", "post_filters.pickle"
+)
+
 
 class AnnotationFilesToEmerald:
-    """Transform external tool's files into EMERALD STR"""
+    """Transform external tool's files into EMERALD STR
+
+    entriesDct maps every protein id to a sorted array("i") of the vocab
+    indexes of its annotations. backend is the inference backend of the
+    BGC model, keras, onnx or tflite"""
+
+    def __init__(self, backend="keras"):
+
+        self.reset()
+        self.backend = backend
+        self.model = None
+        self._mibigIndex = None
+        with open(POST_FILTERS, "rb") as h:
+            self.vocab, self.typeModel, self.mbdoms = pickle.load(h)
 
-    def __init__(self):
+    def reset(self):
+        """Clear the per input state, keeping the loaded models"""
 
         self.entriesDct = {}
         self.contigsDct = {}
         self.annDct = {}
         self.typeDct = {}
         self.annResults = {}
-        post_file = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            "..",
-            "models",
-            "post_filters.pickle",
-        )
-        with open(post_file, "rb") as h:
-            self.vocab, self.typeModel, self.mbdoms = pickle.load(h)
+        self.bridged, self.looseClst, self.borderClst, self.typesClst = {}, {}, {}, {}
+        self.clstIntervals, self.clstTypes = {}, {}
+
+    def releaseContigs(self, contigs):
+        """Drop the state of contigs once they are written"""
+
+        for contig in contigs:
+            for pid, loc in self.contigsDct.pop(contig, []):
+                self.entriesDct.pop(pid, None)
+            for dct in (
+                self.annDct, self.annResults, self.looseClst, self.borderClst,
+                self.typesClst, self.bridged, self.clstIntervals, self.clstTypes,
+            ):
+                dct.pop(contig, None)
+
+    def checkpointContigs(self, contigs=None):
+        """Arrays of the CDS, annotation matrices and per-CDS probabilities
+        of contigs (all when None), the threshold independent state. The
+        probabilities of the padding rows, always 0, are not kept"""
+
+        contigs = list(self.annResults if contigs is None else contigs)
+        mats = [self.annDct[contig] for contig in contigs]
+        cdss = [self.contigsDct[contig] for contig in contigs]
+        return {
+            "contigs": np.array(contigs, dtype=str),
+            "n_cds": np.array([len(x) for x in cdss], dtype=np.int64),
+            "n_rows": np.array([m.shape[0] for m in mats], dtype=np.int64),
+            "cds_ids": np.array([x[0] for c in cdss for x in c], dtype=str),
+            "cds_coords": np.array([x[1] for c in cdss for x in c], dtype=np.int64).reshape(-1, 2),
+            "nnz": np.array([m.indptr[-1] for m in mats], dtype=np.int64),
+            "indptr": np.concatenate([m.indptr[1:] for m in mats] + [np.zeros(0, dtype=np.int64)]),
+            "indices": np.concatenate([m.indices[: m.indptr[-1]] for m in mats] + [np.zeros(0, dtype=np.int32)]),
+            "probabilities": np.concatenate(
+                [self.annResults[contig][: len(x)] for contig, x in zip(contigs, cdss)] + [np.zeros(0)]
+            ),
+        }
+
+    def saveCheckpointPart(self, path, contigs=None):
+        """Write the checkpointContigs arrays of contigs to the NPZ file
+        path, one part of the checkpoint merged by saveCheckpoint"""
+
+        np.savez(path, **self.checkpointContigs(contigs))
+        return path
+
+    def saveCheckpoint(self, path, parts, meta="True"):
+        """Merge the saveCheckpointPart files parts (in contig order) into a
+        compressed NPZ file and remove them. Every array is written part by
+        part, so only one part of one array is in memory at a time"""
+
+        def header(part, key):
+            with zipfile.ZipFile(part) as z, z.open(f"{key}.npy") as h:
+                version = np.lib.format.read_magic(h)
+                if version == (1, 0):
+                    return np.lib.format.read_array_header_1_0(h)
+                return np.lib.format.read_array_header_2_0(h)
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            for key, value in [("version", __version__), ("vocab_size", len(self.vocab)), ("meta", meta)]:
+                with z.open(f"{key}.npy", "w") as h:
+                    np.lib.format.write_array(h, np.array(value))
+            with np.load(parts[0]) as first:
+                keys = list(first.keys())
+            for key in keys:
+                headers = [header(part, key) for part in parts]
+                dtype = np.result_type(*[x[2] for x in headers])
+                shape = (sum(x[0][0] for x in headers),) + headers[0][0][1:]
+                with z.open(f"{key}.npy", "w", force_zip64=True) as h:
+                    np.lib.format.write_array_header_2_0(
+                        h,
+                        {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape},
+                    )
+                    for part in parts:
+                        with np.load(part) as p:
+                            h.write(np.ascontiguousarray(p[key], dtype=dtype).tobytes())
+        for part in parts:
+            os.remove(part)
+        log.info(f"checkpoint {path}")
+        return path
+
+    def loadCheckpoint(self, path):
+        """Restore contigsDct, annDct and annResults from a NPZ checkpoint.
+        Returns the prodigal meta option of the run"""
+
+        self.reset()
+        with np.load(path, allow_pickle=False) as ckpt:
+            if int(ckpt["vocab_size"]) != len(self.vocab):
+                raise SystemExit(
+                    f"{path} was built with other EMERALD models (v{ckpt['version']})"
+                )
+            cdsIds, coords = ckpt["cds_ids"].tolist(), ckpt["cds_coords"].tolist()
+            indptr, indices, probs = ckpt["indptr"], ckpt["indices"], ckpt["probabilities"]
+            cds = rows = nz = 0
+            for contig, nCds, nRows, nnz in zip(
+                ckpt["contigs"].tolist(), ckpt["n_cds"], ckpt["n_rows"], ckpt["nnz"]
+            ):
+                self.contigsDct[contig] = [
+                    (cdsIds[i], tuple(coords[i])) for i in range(cds, cds + nCds)
+                ]
+                self.annDct[contig] = sparse.csr_matrix(
+                    (
+                        np.ones(nnz, dtype=np.int8),
+                        indices[nz : nz + nnz],
+                        np.r_[0, indptr[rows : rows + nRows]],
+                    ),
+                    shape=(nRows, len(self.vocab)),
+                )
+                self.annResults[contig] = np.zeros(nRows, dtype=probs.dtype)
+                self.annResults[contig][:nCds] = probs[cds : cds + nCds]
+                cds, rows, nz = cds + nCds, rows + nRows, nz + nnz
+            return str(ckpt["meta"])
 
     def transformIPS(self, ipsFile):
+        """Stream an InterProScan TSV or GFF3 file into entriesDct, keeping
+        only the accessions in the vocabulary"""
 
         if not os.path.isfile(ipsFile):
             log.exception(f"{ipsFile} file not found")
 
         with open(ipsFile, "r") as h:
 
-            lines = h.readlines()
-            fmt = "gff" if lines[0][:5] == "##gff" else "tsv"
+            first = h.readline()
+            fmt = "gff" if first[:5] == "##gff" else "tsv"
+
+            for l in chain([first], h):
 
-            for l in lines:
-        
                 if fmt == "tsv":
 
-                    spl = l.split("\t")
-                    self.entriesDct.setdefault(spl[0], []).append(
-                        spl[11] if spl[11] != '-' else spl[4]
-                    )
+                    spl = l.rstrip("\n").split("\t")
+                    if len(spl) < 5:
+                        continue
+                    acc = spl[11] if len(spl) > 11 and spl[11] != '-' else spl[4]
+
                 if fmt == "gff":
+                    if l[:7] == "##FASTA":
+                        break
                     spl = l.split("\t")
-                    if len(spl) > 3 and spl[2]=='protein_match':
-                        self.entriesDct.setdefault(spl[0],[]).append(
-                                re.split("InterPro:|\"",spl[-1])[-2] if 'InterPro' in spl[-1]     else re.split("Name=|;",spl[-1])[-2]
-                        )
+                    if not (len(spl) > 3 and spl[2]=='protein_match'):
+                        continue
+                    acc = (
+                        IPS_GFF_IPR.split(spl[-1])[-2]
+                        if 'InterPro' in spl[-1]
+                        else IPS_GFF_NAME.split(spl[-1])[-2]
+                    )
+
+                self.addEntry(spl[0], acc)
+
+    def addEntry(self, protein, acc):
+        """Add the vocab index of acc to the sorted, deduplicated index array
+        of protein in entriesDct. Out of vocabulary accessions are dropped"""
+
+        ix = self.vocab.get(acc)
+        if ix is None:
+            return
+        entries = self.entriesDct.get(protein)
+        if entries is None:
+            entries = self.entriesDct[intern(protein)] = array("i")
+        pos = bisect_left(entries, ix)
+        if pos == len(entries) or entries[pos] != ix:
+            entries.insert(pos, ix)
 
     def transformEmeraldHmm(self, hmmFile):
 
@@ -87,9 +239,12 @@ class AnnotationFilesToEmerald:
                     continue
 
                 spl = l.split()
-                self.entriesDct.setdefault(spl[3], []).append(spl[0])
+                self.addEntry(spl[3], spl[0])
 
     def transformCDSpredToCDScontigs(self, cdsPredFile, f):
+        """CDS coordinates per contig from prodigal fasta headers (fasta), a
+        GenBank file (genbank) or the CDS table written by
+        Preprocess.gbkToProdigal (cds_table)"""
 
         if not os.path.isfile(cdsPredFile):
             log.exception(f"{cdsPredFile} file not found")
@@ -110,13 +265,19 @@ class AnnotationFilesToEmerald:
                         "_".join(spl[0].split("_")[:-1])[1:], []
                     ).append((spl[0][1:], (start, end)))
 
+            elif f == "cds_table":
+
+                for l in h:
+                    contig, pid, start, end = l.rstrip("\n").split("\t")
+                    self.contigsDct.setdefault(contig, []).append(
+                        (pid, (int(start), int(end)))
+                    )
+
             elif f == "genbank":
 
                 from Bio import SeqIO
 
-                recs = list(SeqIO.parse(open(cdsPredFile, "r"), "gb"))
-
-                for rec in recs:
+                for rec in SeqIO.parse(h, "gb"):
                     for f in rec.features:
                         if f.type == "CDS":
 
@@ -132,9 +293,11 @@ class AnnotationFilesToEmerald:
                                 )
                             )
 
-    def buildMatrices(self):
+    def buildMatrices(self, contigs=None):
+        """Scatter entriesDct into a sparse (CSR) CDS x vocab matrix per contig,
+        of all the contigs or only of contigs"""
 
-        for contig in self.contigsDct:
+        for contig in self.contigsDct if contigs is None else contigs:
 
             cdss = self.contigsDct[contig]
 
@@ -144,31 +307,42 @@ class AnnotationFilesToEmerald:
                 else ((len(cdss) // _params["shape"]) + 1) * _params["shape"]
             )
 
-            self.annDct[contig] = np.zeros((samps, len(self.vocab)))
-
-            for ix, cds in enumerate(cdss):
-
-                name = cds[0]
-                if name not in self.entriesDct:
-                    continue
+            rows = [self.entriesDct.get(cds[0], EMPTY_ENTRIES) for cds in cdss]
+            indptr = np.zeros(samps + 1, dtype=np.int64)
+            indptr[1 : len(cdss) + 1] = np.cumsum([len(x) for x in rows])
+            indptr[len(cdss) + 1 :] = indptr[len(cdss)]
+            indices = np.frombuffer(b"".join(rows), dtype=np.intc).astype(np.int32)
+
+            self.annDct[contig] = sparse.csr_matrix(
+                (
+                    np.ones(len(indices), dtype=np.int8),
+                    indices,
+                    indptr,
+                ),
+                shape=(samps, len(self.vocab)),
+            )
 
-                modiAnn = [
-                    self.vocab[x] for x in self.entriesDct[name] if x in self.vocab
-                ]
-                self.annDct[contig][ix][modiAnn] = 1
+    def loadModel(self):
+        """Load the BGC model once per instance. The inference runtime
+        (TensorFlow for keras) is imported here, only when a prediction is
+        needed"""
 
+        if self.model is None:
+            self.model = loadBackend(self.backend)
+        return self.model
 
-    def predictAnn(self, colapseFunc=max):
+    def predictAnn(self, colapseFunc=max, batchSize=None):
+        """Predict per-CDS BGC probabilities.
 
-        log.info("Predict BGC probability w/ TensorFlow")
-        model_BGC_file = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "..", "models", "emerald.h5"
-        )
+        The model windows of all contigs are packed together and sent to
+        the inference backend in batches of about batchSize windows, then
+        scattered back per contig."""
 
-        model = tf.keras.models.load_model(
-            model_BGC_file, custom_objects={"robustLoss": {}}
-        )
+        log.info(f"Predict BGC probability w/ {self.backend}")
+        batchSize = batchSize if batchSize else _params["batch_size"]
+        model = self.loadModel()
 
+        pending, windows, nWin = [], [], 0
         for contig in self.annDct:
             mat = self.annDct[contig]
             xva_, vaIx = self.transformMat(mat)
@@ -179,115 +353,175 @@ class AnnotationFilesToEmerald:
                 [list(xva_[vaS:]) + [0] * (_params["shape"] - (vaIx.shape[0] - vaS))],
                 axis=0,
             )
-            self.predict_ = model.predict(xva)
-            predict = self.predict_.reshape(vaS + _params["shape"])
+            pending.append((contig, vaIx, xva.shape[0], mat.shape[0]))
+            windows.append(xva)
+            nWin += xva.shape[0]
+            if nWin >= batchSize:
+                self._predictBatch(model, pending, windows, batchSize, colapseFunc)
+                pending, windows, nWin = [], [], 0
+
+        if pending:
+            self._predictBatch(model, pending, windows, batchSize, colapseFunc)
+
+    def _predictBatch(self, model, pending, windows, batchSize, colapseFunc):
+
+        log.debug(f"predict {sum(x[2] for x in pending)} windows of {len(pending)} contigs")
+        predict_ = model.predict(np.concatenate(windows), batch_size=batchSize)
+        off = 0
+        for contig, vaIx, nWin, lenOri in pending:
+            predict = predict_[off : off + nWin].reshape(nWin * _params["shape"])
+            off += nWin
             predict_str_, nix = self.partialReStrMat(vaIx, predict, func=colapseFunc)
-            self.annResults[contig] = self.projectRes(predict_str_, nix, mat.shape[0])
+            self.annResults[contig] = self.projectRes(predict_str_, nix, lenOri)
 
     def transformMat(self, mat):
+        """Squash a CSR annotation matrix into its token sequence (column
+        indices in row order) and the CDS index of each token. Repeated
+        tokens in consecutive CDS are collapsed into the first one"""
 
-        scuash = np.array(list(map(lambda x: np.where(x == 1)[0], mat)))
-        nli, nix = [], []
-        for ix, x in enumerate(scuash):
-            if x.shape[0] == 0:
-                continue
-            nli.extend(x)
-            nix.extend([ix] * x.shape[0])
-        sups = [
-            (k, list(zip(*g))[1][0])
-            for k, g in groupby(zip(nli, nix), key=lambda x: x[0])
-        ]
+        nli = mat.indices[: mat.indptr[-1]]
+        nix = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
         if len(nli) == 0:
             return np.array([0]), np.array([0])
-        a, b = list(zip(*sups))
-        a, b = np.array(a), np.array(b)
-        return a, b
+        starts = np.nonzero(np.r_[True, nli[1:] != nli[:-1]])[0]
+        return nli[starts], nix[starts]
 
     def projectRes(self, res, ixes, lenOri):
+        """Project the per-token results back to CDS positions, linearly
+        interpolating the CDS without tokens.
+
+        Gaps are filled with the np.linspace arithmetic in the dtype of res,
+        anchored on the last value reached without a gap, to stay identical
+        to the former per-gap np.linspace loop."""
 
         nres_ = np.zeros(lenOri)
         nres_[ixes] = res
-        prev = 0
-        rprev = 0
-        for ix, r in zip(ixes, res):
-            if ix - 1 == prev:
-                prev = ix
-                rprev = r
-                continue
-            for ixx, s in list(enumerate(np.linspace(rprev, r, ix - prev + 1)))[1:-1]:
-                nres_[prev + ixx] = s
-            prev = ix
+        if len(ixes) == 0:
+            return nres_
+
+        dt = res.dtype if np.issubdtype(res.dtype, np.floating) else np.float64
+        res = res.astype(dt, copy=False)
+        prevs = np.r_[0, ixes[:-1]]
+        steps = ixes - prevs
+
+        last = np.where(steps == 1, np.arange(len(ixes)), -1)
+        last = np.maximum.accumulate(last)[:-1]
+        anchors = np.zeros(len(ixes), dtype=dt)
+        anchors[1:] = np.where(last >= 0, res[last], 0)
+
+        gaps = np.nonzero(steps > 1)[0]
+        lens = steps[gaps] - 1
+        if lens.sum() == 0:
+            return nres_
+        seg = np.repeat(np.arange(len(gaps)), lens)
+        pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens) + 1
+        k = pos.astype(dt)
+        div = steps[gaps].astype(dt)[seg]
+        start = anchors[gaps][seg]
+        delta = res[gaps][seg] - start
+        step = delta / div
+        nres_[prevs[gaps][seg] + pos] = (
+            np.where(step == 0, (k / div) * delta, k * step) + start
+        )
 
         return nres_
 
     def partialReStrMat(self, Ix, res, func):
-
-        nres, nix = [], []
-        for k, g in groupby(zip(res, Ix), key=lambda x: x[1]):
-
-            gg = list(list(zip(*g))[0])
-            nix.append(k)
-            nres.append(func(gg))
-        return np.array(nres), np.array(nix)
+        """Collapse the per-token results of consecutive tokens of the same
+        CDS with func"""
+
+        res = res[: len(Ix)]
+        starts = np.nonzero(np.r_[True, Ix[1:] != Ix[:-1]])[0]
+        reduce = {max: np.maximum, min: np.minimum}.get(func, func)
+        if hasattr(reduce, "reduceat"):
+            nres = reduce.reduceat(res, starts)
+        else:
+            nres = np.array([func(list(g)) for g in np.split(res, starts[1:])])
+        return nres, Ix[starts]
 
     def defineLooseClusters(self, score, g):
-        
+        """Threshold the per-CDS probabilities of all contigs at once and call
+        the cluster intervals ([start, end) CDS indexes) of each contig"""
+
         log.info("Define Clusters")
         self.bridged, self.looseClst, self.borderClst, self.typesClst = {}, {}, {}, {}
+        self.clstIntervals, self.clstTypes = {}, {}
         self.score = _params["greed"][str(g)] if score == None else score
 
-        for contig in self.annResults:
-            self.looseClst[contig] = np.array(
-                self.rmLessThan(
-                    self.fillGap(
-                        np.where(self.annResults[contig] < self.score, 0, 1),
-                        _params["fill"],
-                    ),
-                    _params["rmless"],
-                )
-            )
-            self.borderClst[contig] = np.where(
-                self.annResults[contig] < _params["thBorder"], 0, 1
-            )
-            self.typesClst[contig] = np.empty(
-                len(self.annResults[contig]), dtype=object
-            )
-
-    def rmLessThan(self, contig, n):
-        newContig = []
-        for k, g in groupby(contig):
-            if k == 0:
-                newContig.extend(list(g))
-            else:
-                p = list(g)
-                if len(p) <= n:
-                    newContig.extend([0 for x in p])
-                else:
-                    newContig.extend(p)
-        return newContig
-
-    def fillGap(self, contig, gap):
-        newContig = []
-        for k, g in groupby(contig):
-            gg = list(g)
-            if k == 0 and len(gg) <= gap:
-                newContig.extend([1 for x in gg])
-            else:
-                newContig.extend(gg)
-        return newContig
+        contigs = list(self.annResults)
+        if not contigs:
+            return
+        probs = np.concatenate([self.annResults[contig] for contig in contigs])
+        offsets = np.cumsum([0] + [len(self.annResults[contig]) for contig in contigs])
+        bounds = offsets[1:-1]
+
+        loose = self.rmLessThan(
+            self.fillGap(np.where(probs < self.score, 0, 1), _params["fill"], bounds),
+            _params["rmless"],
+            bounds,
+        )
+        intervals = self.callIntervals(loose, bounds)
+        border = np.where(probs < _params["thBorder"], 0, 1)
+        clstContig = np.searchsorted(offsets, intervals[:, 0], side="right") - 1
+
+        for ix, contig in enumerate(contigs):
+            s, e = offsets[ix], offsets[ix + 1]
+            self.looseClst[contig] = loose[s:e]
+            self.borderClst[contig] = border[s:e]
+            self.clstIntervals[contig] = intervals[clstContig == ix] - s
+            self.typesClst[contig] = np.empty(e - s, dtype=object)
+            self.clstTypes[contig] = {}
+
+    def runLength(self, contig, bounds=None):
+        """Run-length encode a vector. Runs never cross the positions in
+        bounds (start offsets of the contigs in a concatenated vector).
+        Returns the start, length and value of every run"""
+
+        contig = np.asarray(contig)
+        if len(contig) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), contig
+        brk = np.r_[True, contig[1:] != contig[:-1]]
+        if bounds is not None:
+            brk[bounds] = True
+        starts = np.nonzero(brk)[0]
+        lengths = np.diff(np.r_[starts, len(contig)])
+        return starts, lengths, contig[starts]
+
+    def callIntervals(self, contig, bounds=None):
+        """[start, end) intervals of the non-zero runs of a vector"""
+
+        starts, lengths, values = self.runLength(contig, bounds)
+        keep = values != 0
+        return np.column_stack((starts[keep], starts[keep] + lengths[keep]))
+
+    def rmLessThan(self, contig, n, bounds=None):
+        """Set to 0 the non-zero runs not longer than n"""
+
+        starts, lengths, values = self.runLength(contig, bounds)
+        rm = (values != 0) & (lengths <= n)
+        return np.where(np.repeat(rm, lengths), 0, contig)
+
+    def fillGap(self, contig, gap, bounds=None):
+        """Set to 1 the zero runs not longer than gap"""
+
+        starts, lengths, values = self.runLength(contig, bounds)
+        fill = (values == 0) & (lengths <= gap)
+        return np.where(np.repeat(fill, lengths), 1, contig)
 
     def scoreFunc(self, x, b, m):
         y = b+(m*x)
         return 0 if y<0 else 1 if y>1 else y
     
     def predictType(self):
+        """Post-processing filter and type classification of the clusters.
+        clstTypes[contig] maps the first CDS of every accepted cluster to
+        (nearest MIBiG BGC, its class, Dice distance, score)"""
 
         log.info("Predict BGC classes")
 
         type_score = self.scoreFunc(self.score, _params["score_b"], _params["score_m"])
         log.info(f"Positive class model threshold: {type_score}")
         log.info(f"type:{type_score} score {self.score}")
-        locations, matrix, typeLi = [], [], []
         claa = [
             "Alkaloid",
             "NRP",
@@ -298,41 +532,119 @@ class AnnotationFilesToEmerald:
             "Other",
         ]
 
-        for contig in self.contigsDct:
-            for k, g in groupby(enumerate(self.looseClst[contig]), key=lambda x: x[1]):
-                if k == 0:
-                    continue
-                gg = list(list(zip(*g))[0])
-                tmat_ = np.sum(self.annDct[contig][gg], axis=0)
-                tmat = np.where(tmat_ > 0, 1, 0)
-                locations.append((contig, gg))
-                matrix.append(tmat)
-        if len(matrix) > 0:
-            pred = np.empty((len(matrix), len(claa)))
-            for nc, cla in enumerate(claa):
-                pred[:, nc] = self.typeModel[cla].predict_proba(matrix)[:, 1]
-        else:
-            pred = []
-
-        for ix, p in enumerate(pred):
-            
-            contig, gg = locations[ix]
+        contigs = [c for c in self.clstIntervals if len(self.clstIntervals[c])]
+        if not contigs:
+            return
+        matrix = self.clusterMatrix(contigs)
 
-            if not (np.max(p[[0, 1, 2, 3, 4, 5, 6]]) >= type_score):
-                self.looseClst[contig][gg] = 0
-                self.borderClst[contig][gg] = 0
-
-            else:
-                nearest_ = self.near_classifer(set(np.where(matrix[ix] == 1)[0]))
-                nearest = "nearest_MiBIG={};nearest_MiBIG_class={};nearest_MiBIG_diceDistance={:.3f};score={:.3f}".format(
-                    nearest_[0], nearest_[1], nearest_[2], np.max(p[[0, 1, 2, 3, 4, 5, 6]])
-                )
-                self.typesClst[contig][gg] = nearest
+        pred = np.empty((matrix.shape[0], len(claa)))
+        for nc, cla in enumerate(claa):
+            try:
+                pred[:, nc] = self.typeModel[cla].predict_proba(matrix)[:, 1]
+            except (TypeError, ValueError):
+                # class model without sparse input support
+                pred[:, nc] = self.typeModel[cla].predict_proba(matrix.toarray())[:, 1]
+        scores = pred.max(axis=1)
+        accepted = scores >= type_score
+
+        nearests = iter(self.nearestMibigMat(matrix[np.nonzero(accepted)[0]]))
+        offset = 0
+        for contig in contigs:
+            intervals = self.clstIntervals[contig]
+            acc = accepted[offset : offset + len(intervals)]
+            sc = scores[offset : offset + len(intervals)]
+            offset += len(intervals)
+
+            rej = intervals[~acc]
+            if len(rej):
+                mark = np.zeros(len(self.looseClst[contig]) + 1, dtype=int)
+                np.add.at(mark, rej[:, 0], 1)
+                np.add.at(mark, rej[:, 1], -1)
+                inRej = np.cumsum(mark[:-1]) > 0
+                self.looseClst[contig][inRej] = 0
+                self.borderClst[contig][inRej] = 0
+
+            for (start, end), score in zip(intervals[acc], sc[acc]):
+                clstType = next(nearests) + (score,)
+                self.clstTypes[contig][start] = clstType
+                self.typesClst[contig][start:end] = TYPE_ATTRS.format(*clstType)
+            self.clstIntervals[contig] = intervals[acc]
+
+    def clusterMatrix(self, contigs):
+        """Binary sparse cluster x vocab matrix of the clusters of contigs,
+        in clstIntervals order. Each row is the union of the annotations
+        of the cluster CDS, taken as a segment of the contig CSR data"""
+
+        rows, cols, nClst = [], [], 0
+        for contig in contigs:
+            mat = self.annDct[contig]
+            intervals = self.clstIntervals[contig]
+            first, last = mat.indptr[intervals[:, 0]], mat.indptr[intervals[:, 1]]
+            lens = last - first
+            pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+            cols.append(mat.indices[pos + np.repeat(first, lens)])
+            rows.append(np.repeat(np.arange(nClst, nClst + len(intervals)), lens))
+            nClst += len(intervals)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(cols)), (rows, cols)), shape=(nClst, len(self.vocab))
+        )
+        matrix.data[:] = 1
+        return matrix
+
+    def mibigIndex(self):
+        """Sparse binary MIBiG x domain matrix and domain counts of mbdoms,
+        built once per instance"""
+
+        if self._mibigIndex is None:
+            rows, cols = [], []
+            for ix, (b, c, mbd) in enumerate(self.mbdoms):
+                rows.extend([ix] * len(mbd))
+                cols.extend(int(x) for x in mbd)
+            nCols = max([len(self.vocab)] + [x + 1 for x in cols])
+            mat = sparse.csr_matrix(
+                (np.ones(len(cols), dtype=np.int32), (rows, cols)),
+                shape=(len(self.mbdoms), nCols),
+            )
+            mat.data[:] = 1
+            self._mibigIndex = (mat, np.array([len(mbd) for b, c, mbd in self.mbdoms]))
+        return self._mibigIndex
+
+    def nearestMibig(self, domsLi, chunk=1024):
+        """Nearest MIBiG entry (Dice distance) of every domain set in domsLi.
+        Returns a (MIBiG accession, class, diceDistance) tuple per set"""
+
+        mat, mbSizes = self.mibigIndex()
+        domsLi = [np.unique(np.asarray(list(d), dtype=int)) for d in domsLi]
+        rows = np.repeat(np.arange(len(domsLi)), [len(d) for d in domsLi])
+        cols = np.concatenate(domsLi) if domsLi else np.array([], dtype=int)
+        query = sparse.csr_matrix(
+            (np.ones(len(cols), dtype=np.int32), (rows, cols)),
+            shape=(len(domsLi), mat.shape[1]),
+        )
+        return self.nearestMibigMat(query, chunk)
+
+    def nearestMibigMat(self, query, chunk=1024):
+        """nearestMibig of the rows of a binary sparse domain matrix"""
+
+        mat, mbSizes = self.mibigIndex()
+        query = sparse.csr_matrix(query, dtype=np.int32)
+        if query.shape[1] != mat.shape[1]:
+            query.resize((query.shape[0], mat.shape[1]))
+        nearest = []
+        for i in range(0, query.shape[0], chunk):
+            sub = query[i : i + chunk]
+            inter = (sub @ mat.T).toarray()
+            den = sub.getnnz(axis=1)[:, None] + mbSizes[None, :]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                dist = np.where(den > 0, 1 - ((2 * inter) / den), 1)
+            for ix, row in zip(np.argmin(dist, axis=1), dist):
+                b, c, mbd = self.mbdoms[ix]
+                nearest.append((b, c, float(row[ix])))
+        return nearest
 
     def near_classifer(self, doms):
-        mb_ord = [(b, c, self.diceDistance(doms, mbd)) for b, c, mbd in self.mbdoms]
-        nearest = sorted(mb_ord, key=lambda x: x[2])[0]
-        return nearest
+        return self.nearestMibig([doms])[0]
 
     def jacardDistance(self, a, b):
         try:
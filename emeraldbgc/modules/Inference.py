@@ -0,0 +1,132 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+
+log = logging.getLogger(f"EMERALD.{__name__}")
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+
+MODEL_FILES = {
+    "keras": "emerald.h5",
+    "onnx": "emerald.onnx",
+    "tflite": "emerald.tflite",
+}
+
+ONNX_DTYPES = {
+    "tensor(float)": "float32",
+    "tensor(double)": "float64",
+    "tensor(int32)": "int32",
+    "tensor(int64)": "int64",
+}
+
+
+def modelFile(backend):
+    return os.path.join(MODELS_DIR, MODEL_FILES[backend])
+
+
+def loadBackend(backend="keras"):
+    """BGC model for backend. Every backend has a keras like
+    predict(x, batch_size) method"""
+
+    if backend not in MODEL_FILES:
+        raise SystemExit(
+            f"unknown inference backend {backend}, one of {', '.join(MODEL_FILES)}"
+        )
+    path = modelFile(backend)
+    if not os.path.isfile(path):
+        log.error(f"{path} not found")
+        if backend == "keras":
+            raise SystemExit(f"{path} not found")
+        raise SystemExit(
+            f"{path} not found. Convert the keras model with emerald_export_model --format {backend}"
+        )
+    log.info(f"{backend} inference backend, {path}")
+    return {"keras": KerasModel, "onnx": OnnxModel, "tflite": TFLiteModel}[backend](path)
+
+
+class KerasModel:
+    """Full TensorFlow runtime"""
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self.model = tf.keras.models.load_model(path, custom_objects={"robustLoss": {}})
+
+    def predict(self, x, batch_size=32):
+        return self.model.predict(x, batch_size=batch_size, verbose=0)
+
+
+class OnnxModel:
+    """ONNX Runtime on CPU"""
+
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise SystemExit("onnx backend requires onnxruntime, pip install onnxruntime")
+
+        self.session = onnxruntime.InferenceSession(
+            path, providers=["CPUExecutionProvider"]
+        )
+        inp = self.session.get_inputs()[0]
+        self.inputName = inp.name
+        self.dtype = ONNX_DTYPES.get(inp.type, "float32")
+
+    def predict(self, x, batch_size=32):
+        import numpy as np
+
+        x = np.asarray(x, dtype=self.dtype)
+        return np.concatenate(
+            [
+                self.session.run(None, {self.inputName: x[i : i + batch_size]})[0]
+                for i in range(0, len(x), batch_size)
+            ]
+        )
+
+
+class TFLiteModel:
+    """TFLite interpreter, from tflite_runtime if installed"""
+
+    def __init__(self, path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tensorflow.lite import Interpreter
+            except ImportError:
+                raise SystemExit(
+                    "tflite backend requires tflite-runtime, pip install tflite-runtime"
+                )
+
+        self.interpreter = Interpreter(model_path=path)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch = None
+
+    def predict(self, x, batch_size=32):
+        import numpy as np
+
+        x = np.asarray(x, dtype=self.input["dtype"])
+        out = []
+        for i in range(0, len(x), batch_size):
+            xb = x[i : i + batch_size]
+            if self.batch != xb.shape:
+                self.interpreter.resize_tensor_input(self.input["index"], xb.shape)
+                self.interpreter.allocate_tensors()
+                self.batch = xb.shape
+            self.interpreter.set_tensor(self.input["index"], xb)
+            self.interpreter.invoke()
+            out.append(self.interpreter.get_tensor(self.output["index"]))
+        return np.concatenate(out)
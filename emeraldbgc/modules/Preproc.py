@@ -11,181 +11,498 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 import os
+import re
+import shutil
 import sys
 import subprocess
-from Bio import SeqIO
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 from emeraldbgc import _params
+from modules.AnnotationCache import AnnotationCache
 log = logging.getLogger(f"EMERALD.{__name__}")
 
-from distutils.spawn import find_executable
+HMM_LIB = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "models", "hmm_lib", "emerald.hmm"
+)
+
+PRODIGAL_ID = re.compile(r"# ID=(\d+)_")
 
 class Preprocess:
     """External tools needed for emerald bgc detection"""
 
-    def __init__(self, seq_file, ip_file, meta, cpus, outdir):
+    def __init__(
+        self, seq_file, ip_file, meta, cpus, outdir, hmmsearch="False", cache=None, report=None, markers=None
+    ):
 
         self.seq_file = seq_file
         self.ip_file = ip_file
         self.meta = meta
         self.cpus = int(cpus)
         self.outdir = outdir if outdir else "temp"
+        self.hmmsearch = hmmsearch
+        self.timings = {}
+        self.cache = AnnotationCache(cache) if cache else None
+        self.report = report
+        self.markers = markers
+        self.nProteins = None
 
     def runProdigal(self):
-        """Predict genes using prodigal"""
+        """Predict genes using prodigal.
+
+        In meta mode every contig is predicted independently, so the input
+        is split in up to self.cpus shards of similar size that run
+        concurrently; their outputs are merged in the input order"""
         log.info("Progial gene prediction...")
 
-        if not find_executable("prodigal"):
+        if not shutil.which("prodigal"):
             log.exception("Parodigal is not installed or in PATH")
 
         if not os.path.isfile(self.seq_file):
             log.exception(f"{self.seq_file} file not found")
 
-        outFaa = os.path.join(
-            self.outdir, "{}.prodigal.faa".format(os.path.basename(self.seq_file))
-        )
-        cmd = ["prodigal", "-i", self.seq_file, "-a", outFaa] + (
-            ["-p", "meta"] if self.meta == "True" else []
-        )
+        outFaa = self.faaFile()
 
-        outs, errs = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        ).communicate()
-
-        if "Error:  Sequence must be 20000 characters" in errs.decode("utf8"):
-
-            log.info(
-                "Sequence must be 20000 characters when running Prodigal in normal mode. Trying -p meta"
-            )
-
-            cmd = ["prodigal", "-i", self.seq_file, "-a", outFaa, "-m"] + (["-p", "meta"])
-
-            outs, errs = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            ).communicate()
+        shardDir = os.path.join(self.outdir, "prodigal_shards")
+        shards = (
+            self.splitFasta(self.seq_file, self.cpus, shardDir)
+            if self.meta == "True" and self.cpus > 1
+            else []
+        )
 
-        log.info(errs.decode("utf8"))
+        if len(shards) > 1:
+            log.info(f"prodigal on {len(shards)} shards")
+            shardFaas = [f"{shard}.faa" for shard, nSeqs in shards]
+            with ThreadPoolExecutor(len(shards)) as executor:
+                list(executor.map(self.prodigalShard, [x[0] for x in shards], shardFaas))
+
+            """ Merge shards renumbering prodigal's sequence ordinal (ID=<seq>_<gene>)
+                """
+            offset = 0
+            with open(outFaa, "w") as h:
+                for (shard, nSeqs), shardFaa in zip(shards, shardFaas):
+                    with open(shardFaa, "r") as hs:
+                        for l in hs:
+                            if l[0] == ">":
+                                l = PRODIGAL_ID.sub(
+                                    lambda m: f"# ID={int(m.group(1)) + offset}_", l, count=1
+                                )
+                            h.write(l)
+                    offset += nSeqs
+        else:
+            self.prodigalShard(self.seq_file, outFaa)
+        shutil.rmtree(shardDir, ignore_errors=True)
 
         """ Remove asterixs from faa
             """
         log.info("Removing asterix from prodigal faa")
         with open(outFaa, "r") as h:
             noAstFaa = [x.replace("*", "") for x in h]
+        self.nProteins = sum(1 for l in noAstFaa if l[0] == ">")
         with open(outFaa, "w") as h:
             for l in noAstFaa:
                 h.write(f"{l}")
 
         return os.path.abspath(outFaa)
 
+    def prodigalShard(self, seqFile, outFaa):
+        """Run prodigal on a single nucleotide file"""
+
+        cmd = ["prodigal", "-i", seqFile, "-a", outFaa] + (
+            ["-p", "meta"] if self.meta == "True" else []
+        )
+
+        outs, errs, code = self.runCommand(cmd, check=False)
+
+        if "Error:  Sequence must be 20000 characters" in errs:
+
+            log.info(
+                "Sequence must be 20000 characters when running Prodigal in normal mode. Trying -p meta"
+            )
+
+            cmd = ["prodigal", "-i", seqFile, "-a", outFaa, "-m"] + (["-p", "meta"])
+
+            outs, errs, code = self.runCommand(cmd, check=False)
+
+        log.info(errs)
+        self.checkCommand(cmd, code, errs)
+
+    def runCommand(self, cmd, check=True):
+        """Run cmd, returns its (stdout, stderr, exit status). With check, a
+        non-zero exit status raises subprocess.CalledProcessError"""
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        outs, errs = proc.communicate()
+        outs, errs = outs.decode("utf8"), errs.decode("utf8")
+        if check:
+            self.checkCommand(cmd, proc.returncode, errs)
+        return outs, errs, proc.returncode
+
+    def checkCommand(self, cmd, code, errs):
+        """Raise on the non-zero exit status of cmd, so its partial outputs
+        are neither cached nor marked as complete"""
+
+        if code != 0:
+            log.error(f"{' '.join(cmd)} exited with status {code}\n{errs}")
+            raise subprocess.CalledProcessError(code, cmd, stderr=errs)
+
+    def splitFasta(self, fasta, n, shardDir):
+        """Split a FASTA file in up to n shards of consecutive records with a
+        similar number of residues. Returns a (shard file, number of
+        records) tuple per shard"""
+
+        sizes = []
+        with open(fasta, "r") as h:
+            for l in h:
+                if l[0] == ">":
+                    sizes.append(0)
+                elif sizes:
+                    sizes[-1] += len(l.strip())
+
+        total = sum(sizes) if sum(sizes) else 1
+        cum, shardOf = 0, []
+        for size in sizes:
+            shardOf.append(min(n - 1, int((cum + size / 2) * n / total)))
+            cum += size
+
+        os.makedirs(shardDir, exist_ok=True)
+        base = os.path.basename(fasta)
+        shards, h, ix = [], None, -1
+        with open(fasta, "r") as hf:
+            for l in hf:
+                if l[0] == ">":
+                    ix += 1
+                    if not shards or shards[-1][2] != shardOf[ix]:
+                        if h:
+                            h.close()
+                        shards.append([os.path.join(shardDir, f"{base}.{shardOf[ix]}"), 0, shardOf[ix]])
+                        h = open(shards[-1][0], "w")
+                    shards[-1][1] += 1
+                if h:
+                    h.write(l)
+        if h:
+            h.close()
+
+        return [(shard, nSeqs) for shard, nSeqs, k in shards]
+
     def gbkToProdigal(self):
-        """Transform gbk to faa. This enables preprocessing with sequences"""
+        """Transform gbk to faa. This enables preprocessing with sequences.
+
+        Single streaming pass over the records, that also writes the CDS
+        coordinates table (self.cdsTable) read by the detection in place
+        of the GenBank file"""
         log.info("write gbk as faa")
         from Bio import SeqIO
 
-        recs = list(SeqIO.parse(open(self.seq_file, "r"), "gb"))
+        outFaa = self.faaFile()
+        self.cdsTable = f"{outFaa}.cds.tsv"
 
-        base = os.path.basename(self.seq_file)
+        self.nProteins = 0
+        with open(self.seq_file, "r") as hg, open(outFaa, "w") as h, open(self.cdsTable, "w") as ht:
 
-        outFaa = os.path.join(
-            self.outdir, "{}.prodigal.faa".format(os.path.basename(self.seq_file))
-        )
-
-        with open(outFaa, "w") as h:
-
-            for rec in recs:
+            for rec in SeqIO.parse(hg, "gb"):
                 ct = 0
                 for f in rec.features:
 
-                    
-                    if f.type == "CDS" and "translation" in f.qualifiers:
+                    if f.type != "CDS":
+                        continue
+                    pid = (
+                        f.qualifiers["protein_id"][0]
+                        if "protein_id" in f.qualifiers
+                        else f.qualifiers["locus_tag"][0]
+                    )
+                    ht.write(f"{rec.id}\t{pid}\t{int(f.location.start) + 1}\t{int(f.location.end)}\n")
+
+                    if "translation" in f.qualifiers:
                         ct += 1
-                        pid = (
-                            f.qualifiers["protein_id"][0].replace(" ","")
-                            if "protein_id" in f.qualifiers
-                            else f.qualifiers["locus_tag"][0]
-                        )
                         seq = f.qualifiers["translation"][0]
-                        h.write(f">{pid}\n{seq}\n")
+                        h.write(f">{pid.replace(' ', '')}\n{seq}\n")
                         
+                self.nProteins += ct
                 if ct == 0:
                     log.info("{} CDS found with translation in {}".format(ct, rec.name) )
 
         return os.path.abspath(outFaa)
 
     def check_fmt(self):
-        """ Evaluate if input format is FNA or GBK"""
-        for fmt in ["fasta","genbank"]:
-            seqFile = SeqIO.parse(open(self.seq_file),fmt)
-            if any(seqFile):
-                self.fmt = fmt
-                log.info(f"{fmt} sequence file detected")
-                return
-        log.exception(f"sequence file {self.seq_file} not in fasta or genbank format")
-        raise SystemExit(f"sequence file {self.seq_file} not in fasta or genbank format")
+        """ Evaluate if input format is FNA or GBK from the first bytes"""
+
+        with open(self.seq_file, "r") as h:
+            head = ""
+            for l in h:
+                if l.strip():
+                    head = l.lstrip()
+                    break
+        if head.startswith(">"):
+            self.fmt = "fasta"
+        elif head.startswith("LOCUS"):
+            self.fmt = "genbank"
+        else:
+            log.exception(f"sequence file {self.seq_file} not in fasta or genbank format")
+            raise SystemExit(f"sequence file {self.seq_file} not in fasta or genbank format")
+        log.info(f"{self.fmt} sequence file detected")
 
 
     def process_sequence(self):
-        """ CDS prediction on sequence file"""
+        """ CDS prediction on sequence file, then InterProScan and hmmscan
+        running concurrently on a shared cpu budget. Stage wall times
+        (seconds) are kept in self.timings"""
 
+        self.timings = {}
         self.check_fmt()
         if self.fmt == "fasta":
-            self.outFaa = self.runProdigal()
+            self.outFaa = self.resumable(
+                "prodigal",
+                self.runProdigal,
+                [self.seq_file],
+                lambda: {
+                    "meta": self.meta,
+                    "prodigal": self.toolVersion(["prodigal", "-v"], "Prodigal"),
+                },
+                [self.faaFile()],
+            )
         elif self.fmt == "genbank":
-            self.outFaa = self.gbkToProdigal()
+            self.cdsTable = f"{self.faaFile()}.cds.tsv"
+            self.outFaa = self.resumable(
+                "gbk_to_faa",
+                self.gbkToProdigal,
+                [self.seq_file],
+                lambda: {},
+                [self.faaFile(), self.cdsTable],
+            )
         else:
             log.info("missing sequence file format")
 
-        ip_f = self.runInterproscan() if self.ip_file == None else self.ip_file
-        ih_f = self.runHmmScan()
+        ip_f, ih_f = self.annotateProteins()
         return self.outFaa, ip_f, ih_f
 
-    def runHmmScan(self):
-        """annotate functionally with emerald hmm library and hmmScan"""
-        log.info("emerald functional annotation...")
-        hmmLib = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            "..",
-            "models",
-            "hmm_lib",
-            "emerald.hmm",
+    def annotateProteins(self):
+        """InterProScan and hmmscan on self.outFaa"""
+
+        ips = self.cachedInterproscan if self.cache else self.runInterproscan
+        hmm = self.cachedHmmScan if self.cache else self.runHmmScan
+        tool = "hmmsearch" if self.hmmsearch == "True" else "hmmscan"
+
+        def runIps(cpus):
+            return self.resumable(
+                "interproscan",
+                ips,
+                [self.outFaa],
+                lambda: {
+                    "interproscan": self.toolVersion(["interproscan.sh", "--version"], "version"),
+                    "applications": _params["ip_an"],
+                },
+                [self.ipsFile()],
+                cpus=cpus,
+            )
+
+        def runHmm(cpus):
+            return self.resumable(
+                "hmmscan",
+                hmm,
+                [self.outFaa, HMM_LIB],
+                lambda: {"tool": tool, "version": self.toolVersion([tool, "-h"], "HMMER")},
+                [self.hmmFile()],
+                cpus=cpus,
+            )
+
+        if self.ip_file != None:
+            ip_f = self.ip_file
+            ih_f = runHmm(self.cpus)
+        elif self.cpus < 2:
+            ip_f = runIps(self.cpus)
+            ih_f = runHmm(self.cpus)
+        else:
+            hmmCpus = max(1, int(self.cpus * _params["hmm_cpu_share"]))
+            ipsCpus = max(1, self.cpus - hmmCpus)
+            log.info(f"InterProScan ({ipsCpus} cpus) and hmmscan ({hmmCpus} cpus) concurrently")
+            with ThreadPoolExecutor(2) as executor:
+                ipsFuture = executor.submit(runIps, ipsCpus)
+                hmmFuture = executor.submit(runHmm, hmmCpus)
+                ip_f, ih_f = ipsFuture.result(), hmmFuture.result()
+
+        log.info(
+            "stage timings: "
+            + ", ".join(f"{k} {v:.1f}s" for k, v in self.timings.items())
+        )
+        return ip_f, ih_f
+
+    def resumable(self, stage, func, inputs, params, outputs, **kwargs):
+        """timed func, skipped when self.markers (StageMarkers) has stage up
+        to date. params() returns the tool versions and parameters of the
+        stage, outputs[0] is the path returned by func. Without resume the
+        stage marker is only removed, params() is not called and the inputs
+        are not hashed"""
+
+        if not self.markers or not self.markers.resume:
+            if self.markers:
+                self.markers.start(stage)
+            return self.timed(stage, func, **kwargs)
+        params = params()
+        if self.markers.current(stage, inputs, params, outputs):
+            return os.path.abspath(outputs[0])
+        self.markers.start(stage)
+        out = self.timed(stage, func, **kwargs)
+        self.markers.done(stage, inputs, params, outputs)
+        return out
+
+    def timed(self, stage, func, **kwargs):
+        """Run func keeping its wall time in self.timings, and its usage in
+        self.report (RunReport) when given"""
+
+        start = time.perf_counter()
+        with self.report.stage(stage) if self.report else nullcontext({}) as counts:
+            try:
+                out = func(**kwargs)
+            finally:
+                self.timings[stage] = time.perf_counter() - start
+            if self.nProteins is not None:
+                counts["proteins"] = self.nProteins
+            return out
+
+    def cachedInterproscan(self, cpus=None):
+        """runInterproscan only on the proteins missing from the annotation cache"""
+
+        version = self.toolVersion(["interproscan.sh", "--version"], "version")
+        return self.cache.annotate(
+            "interproscan:{}:{}".format(version, ",".join(_params["ip_an"])),
+            self.outFaa,
+            self.ipsFile(),
+            lambda faa, outGff: self.runInterproscan(faa, outGff, cpus),
+            "\t",
+            0,
+            f"{self.outFaa}.ip.uncached.faa",
         )
 
-        if not find_executable("hmmscan"):
-            log.exception("hmmscan is not installed or in PATH")
+    def cachedHmmScan(self, cpus=None):
+        """runHmmScan only on the proteins missing from the annotation cache"""
+
+        md5 = hashlib.md5()
+        with open(HMM_LIB, "rb") as h:
+            for chunk in iter(lambda: h.read(1 << 20), b""):
+                md5.update(chunk)
+        tool = "hmmsearch" if self.hmmsearch == "True" else "hmmscan"
+        version = self.toolVersion([tool, "-h"], "HMMER")
+        return self.cache.annotate(
+            f"emerald_hmm:{tool}:{version}:{md5.hexdigest()}",
+            self.outFaa,
+            self.hmmFile(),
+            lambda faa, outTsv: self.runHmmScan(faa, outTsv, cpus),
+            None,
+            3,
+            f"{self.outFaa}.hmm.uncached.faa",
+        )
 
-        if not os.path.isfile(self.outFaa):
-            log.exception(f"{self.outFaa} file not found")
+    def toolVersion(self, cmd, tag):
+        """First line of the cmd output containing tag"""
 
-        if not os.path.isfile(hmmLib):
-            log.exception(f"{hmmLib} file not found")
+        if not shutil.which(cmd[0]):
+            return ""
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        outs = res.stdout + res.stderr
+        return next((l.strip() for l in outs.split("\n") if tag in l), "")
 
-        outTsv = os.path.join(
-            self.outdir, "{}.emerald.tsv".format(os.path.basename(self.outFaa))
+    def faaFile(self):
+        return os.path.abspath(
+            os.path.join(self.outdir, "{}.prodigal.faa".format(os.path.basename(self.seq_file)))
         )
 
-        cmd = (
-            ["hmmscan", "--domtblout", outTsv, "--cut_ga"]
-            + (["--cpu", str(self.cpus)] if self.cpus else [])
-            + ([hmmLib, self.outFaa])
+    def ipsFile(self):
+        return os.path.join(
+            self.outdir, "{}.ip.tsv".format(os.path.basename(self.outFaa))
+        )
+
+    def hmmFile(self):
+        return os.path.join(
+            self.outdir, "{}.emerald.tsv".format(os.path.basename(self.outFaa))
         )
-        log.info(" ".join(cmd))
-        try:
-            outs, errs = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            ).communicate()
-            log.info(errs.decode("utf8"))
-        except subprocess.CalledProcessError as err:
-            log.exception(err.output)
+
+    def runHmmScan(self, faa=None, outTsv=None, cpus=None):
+        """annotate functionally with emerald hmm library and hmmScan.
+
+        With more than one cpu the proteins are split in shards that run in
+        concurrent single-threaded workers, and the domtblout outputs are
+        concatenated. hmmsearch writes its output in hmmscan's layout"""
+        log.info("emerald functional annotation...")
+        hmmLib = HMM_LIB
+        faa = faa if faa else self.outFaa
+        outTsv = outTsv if outTsv else self.hmmFile()
+        cpus = cpus if cpus else self.cpus
+        tool = "hmmsearch" if self.hmmsearch == "True" else "hmmscan"
+
+        if not shutil.which(tool):
+            log.exception(f"{tool} is not installed or in PATH")
+
+        if not os.path.isfile(faa):
+            log.exception(f"{faa} file not found")
+
+        if not os.path.isfile(hmmLib):
+            log.exception(f"{hmmLib} file not found")
+
+        shardDir = os.path.join(self.outdir, "hmm_shards")
+        shards = self.splitFasta(faa, cpus, shardDir) if cpus > 1 else []
+
+        if len(shards) > 1:
+            log.info(f"{tool} on {len(shards)} shards")
+            shardTsvs = [f"{shard}.domtblout" for shard, nSeqs in shards]
+            with ThreadPoolExecutor(len(shards)) as executor:
+                list(
+                    executor.map(
+                        lambda x: self.hmmShard(tool, hmmLib, x[0], x[1], 1),
+                        zip([x[0] for x in shards], shardTsvs),
+                    )
+                )
+            with open(outTsv, "w") as h:
+                for shardTsv in shardTsvs:
+                    with open(shardTsv, "r") as hs:
+                        shutil.copyfileobj(hs, h)
+        else:
+            self.hmmShard(tool, hmmLib, faa, outTsv, cpus)
+        shutil.rmtree(shardDir, ignore_errors=True)
 
         return os.path.abspath(outTsv)
 
-    def runInterproscan(self):
+    def hmmShard(self, tool, hmmLib, faa, outTsv, cpus):
+        """Run hmmscan or hmmsearch on a single protein file"""
+
+        cmd = (
+            [tool, "--domtblout", outTsv, "--cut_ga"]
+            + (["--cpu", str(cpus)] if cpus else [])
+            + ([hmmLib, faa])
+        )
+        log.info(" ".join(cmd))
+        outs, errs, code = self.runCommand(cmd)
+        log.info(errs)
+
+        if tool == "hmmsearch" and os.path.isfile(outTsv):
+            self.hmmscanLayout(outTsv)
+
+    def hmmscanLayout(self, outTsv):
+        """Swap target (sequence) and query (profile) columns of a hmmsearch
+        domtblout to hmmscan's layout"""
+
+        with open(outTsv, "r") as h:
+            lines = h.readlines()
+        with open(outTsv, "w") as h:
+            for l in lines:
+                if l[0] == "#":
+                    h.write(l)
+                    continue
+                spl = l.split(maxsplit=22)
+                h.write(" ".join(spl[3:6] + spl[:3] + spl[6:]).rstrip("\n") + "\n")
+
+    def runInterproscan(self, faa=None, outGff=None, cpus=None):
         """annotate functionally with InterproScan"""
         log.info("InterProScan")
+        faa = faa if faa else self.outFaa
+        outGff = outGff if outGff else self.ipsFile()
+        cpus = cpus if cpus else self.cpus
 
-        if not find_executable('interproscan.sh'):
+        if not shutil.which('interproscan.sh'):
             print("\nInterProScan (IPS) executable interproscan.sh could not be found\n")
             print("If IPS is not installed. Make sure to run emeraldbgc with --ip-file option\n")
             print("Alternatively:")
@@ -195,25 +512,20 @@ class Preprocess:
             log.exception(f"interproscan.sh not found, only available for Linux OS")
             raise SystemExit('interproscan.sh not found')
 
-        if not os.path.isfile(self.outFaa):
-            log.exception(f"self.outFaa file not found")
+        if not os.path.isfile(faa):
+            log.exception(f"{faa} file not found")
 
-        outGff = os.path.join(
-            self.outdir, "{}.ip.tsv".format(os.path.basename(self.outFaa))
-        )
         os.environ['LD_LIBRARY_PATH'] = os.path.join(os.environ["CONDA_PREFIX"], "lib")
         os.environ["PERL5LIB"] = ""
         cmd = (
-            ["interproscan.sh", "-i", self.outFaa, "-o", outGff, "-f", "TSV"]
+            ["interproscan.sh", "-i", faa, "-o", outGff, "-f", "TSV"]
             + (["-appl", ",".join(_params["ip_an"])] if _params["ip_an"] else [])
-            + (["-cpu", str(self.cpus)] if self.cpus else [])
+            + (["-cpu", str(cpus)] if cpus else [])
         )
         log.info(" ".join(cmd))
 
-        outs, errs = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        ).communicate()
-        log.info(outs.decode("utf8"))
-        log.info(errs.decode("utf8"))
+        outs, errs, code = self.runCommand(cmd)
+        log.info(outs)
+        log.info(errs)
 
         return os.path.abspath(outGff)
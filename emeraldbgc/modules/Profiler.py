@@ -0,0 +1,91 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+log = logging.getLogger(f"EMERALD.{__name__}")
+
+
+class Profiler:
+    """cProfile and stack sampling of one stage, or of the whole run when
+    stage is "all".
+
+    write saves PREFIX.pstats (python -m pstats, snakeviz) and
+    PREFIX.collapsed, the sampled stacks of the profiled thread in the
+    collapsed format of flamegraph.pl and speedscope"""
+
+    def __init__(self, prefix, stage="all", interval=0.005):
+
+        self.prefix = prefix
+        self.stage = stage
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.stacks = Counter()
+
+    @contextmanager
+    def scope(self, name="all"):
+        """Profile the with block when name is the profiled stage"""
+
+        if name != self.stage:
+            yield
+            return
+
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self.sample, args=(threading.get_ident(), stop), daemon=True
+        )
+        sampler.start()
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            stop.set()
+            sampler.join()
+
+    def sample(self, ident, stop):
+        """Count the stack of thread ident every self.interval seconds"""
+
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self):
+
+        self.profile.dump_stats(f"{self.prefix}.pstats")
+        with open(f"{self.prefix}.collapsed", "w") as h:
+            for stack, n in self.stacks.most_common():
+                h.write(f"{stack} {n}\n")
+
+        if not self.profile.getstats():
+            log.warning(f"profiled stage {self.stage} did not run")
+            return
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(20)
+        log.info(f"profile {self.stage}: {self.prefix}.pstats {self.prefix}.collapsed\n{out.getvalue()}")
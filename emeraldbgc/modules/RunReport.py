@@ -0,0 +1,115 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+
+from emeraldbgc import __version__
+
+log = logging.getLogger(f"EMERALD.{__name__}")
+
+
+def usage():
+    """(wall, cpu, peak RSS MiB, children cpu, children peak RSS MiB) now"""
+
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    ch = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        time.perf_counter(),
+        time.process_time(),
+        me.ru_maxrss / 1024,
+        ch.ru_utime + ch.ru_stime,
+        ch.ru_maxrss / 1024,
+    )
+
+
+class RunReport:
+    """Wall time, CPU time, peak RSS and item counts of the pipeline stages.
+
+    A stage run several times (a stage of every contig chunk) adds up in
+    one entry. The child process usage (prodigal, hmmscan, InterProScan)
+    is that of the children finished during the stage. Stages running
+    concurrently share the process counters, so their CPU times overlap.
+    Stages are profiled with profiler (Profiler) when given"""
+
+    def __init__(self, path=None, args=None, profiler=None):
+
+        self.path = path
+        self.args = args
+        self.profiler = profiler
+        self.stages = {}
+        self.start = usage()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the with block as stage name. Yields a dict for the item
+        counts of the stage"""
+
+        counts = {}
+        before = usage()
+        try:
+            with self.profiler.scope(name) if self.profiler else nullcontext():
+                yield counts
+        finally:
+            after = usage()
+            st = self.stages.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "wall_s": 0.0,
+                    "cpu_s": 0.0,
+                    "peak_rss_mib": 0.0,
+                    "rss_delta_mib": 0.0,
+                    "children_cpu_s": 0.0,
+                    "children_peak_rss_mib": 0.0,
+                    "counts": {},
+                },
+            )
+            st["calls"] += 1
+            st["wall_s"] += after[0] - before[0]
+            st["cpu_s"] += after[1] - before[1]
+            st["peak_rss_mib"] = after[2]
+            st["rss_delta_mib"] += after[2] - before[2]
+            st["children_cpu_s"] += after[3] - before[3]
+            st["children_peak_rss_mib"] = after[4]
+            for k, v in counts.items():
+                st["counts"][k] = st["counts"].get(k, 0) + v
+            log.info(
+                f"{name}: {after[0] - before[0]:.2f}s wall {after[1] - before[1]:.2f}s cpu "
+                f"{after[3] - before[3]:.2f}s children cpu, peak RSS {after[2]:.0f} MiB "
+                + " ".join(f"{k} {v}" for k, v in counts.items())
+            )
+
+    def report(self):
+
+        end = usage()
+        return {
+            "version": __version__,
+            "args": self.args,
+            "wall_s": end[0] - self.start[0],
+            "cpu_s": end[1] - self.start[1],
+            "peak_rss_mib": end[2],
+            "children_cpu_s": end[3] - self.start[3],
+            "children_peak_rss_mib": end[4],
+            "stages": self.stages,
+        }
+
+    def write(self):
+        """Write the JSON report in self.path"""
+
+        log.info(f"run report: {self.path}")
+        with open(self.path, "w") as h:
+            json.dump(self.report(), h, indent=1)
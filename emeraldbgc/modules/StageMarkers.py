@@ -0,0 +1,133 @@
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+
+from emeraldbgc import __version__
+
+log = logging.getLogger(f"EMERALD.{__name__}")
+
+# stages with a completion marker, in pipeline order
+RESUMABLE = ["prodigal", "gbk_to_faa", "interproscan", "hmmscan", "predictAnn"]
+
+
+class StageMarkers:
+    """Completion markers of the pipeline stages, OUTDIR/emerald.STAGE.done.
+
+    A marker keeps the size, mtime and md5 of the stage inputs, the tool /
+    model versions and parameters, and the size of the outputs. It is
+    removed when the stage starts and, with resume only, written when it
+    ends. With resume a stage is up to date when its marker matches and its
+    outputs exist, unless the stage is in force. An input with the size and
+    mtime of the marker is not hashed again. As the inputs of a stage are
+    the outputs of the previous ones, a stage re-run with a different
+    output re-runs the next ones"""
+
+    def __init__(self, outdir, resume=False, force=()):
+
+        self.outdir = outdir
+        self.resume = resume
+        self.force = set(force)
+        self.hashes = {}
+
+    def path(self, stage):
+        return os.path.join(self.outdir, f"emerald.{stage}.done")
+
+    def md5(self, path):
+        """md5 of the file content, computed once per file version"""
+
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        if key not in self.hashes:
+            md5 = hashlib.md5()
+            with open(path, "rb") as h:
+                for chunk in iter(lambda: h.read(1 << 20), b""):
+                    md5.update(chunk)
+            self.hashes[key] = md5.hexdigest()
+        return self.hashes[key]
+
+    def marker(self, stage, inputs, params, outputs):
+
+        return {
+            "stage": stage,
+            "emerald": __version__,
+            "inputs": {os.path.abspath(x): self.stat(x) for x in inputs},
+            "params": params,
+            "outputs": {os.path.abspath(x): os.path.getsize(x) for x in outputs},
+        }
+
+    def stat(self, path, md5=True):
+
+        st = os.stat(path)
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "md5": self.md5(path) if md5 else None,
+        }
+
+    def sameInput(self, path, done):
+        """True when path has the content of the marker entry done. The
+        md5 is computed only when the size matches but not the mtime"""
+
+        st = self.stat(path, md5=False)
+        if st["size"] != done["size"]:
+            return False
+        return st["mtime_ns"] == done["mtime_ns"] or self.md5(path) == done["md5"]
+
+    def current(self, stage, inputs, params, outputs):
+        """True when stage is up to date and can be skipped"""
+
+        if not self.resume or stage in self.force:
+            return False
+        if not all(os.path.isfile(x) for x in [self.path(stage)] + inputs + outputs):
+            return False
+        with open(self.path(stage), "r") as h:
+            try:
+                done = json.load(h)
+            except ValueError:
+                return False
+        expected = {
+            "stage": stage,
+            "emerald": __version__,
+            "params": json.loads(json.dumps(params)),
+            "outputs": {os.path.abspath(x): os.path.getsize(x) for x in outputs},
+        }
+        if (
+            any(done.get(k) != v for k, v in expected.items())
+            or sorted(done.get("inputs", {})) != sorted(os.path.abspath(x) for x in inputs)
+            or not all(self.sameInput(x, done["inputs"][os.path.abspath(x)]) for x in inputs)
+        ):
+            log.info(f"{stage} out of date")
+            return False
+        log.info(f"{stage} up to date, skipped")
+        return True
+
+    def start(self, stage):
+
+        if os.path.isfile(self.path(stage)):
+            os.remove(self.path(stage))
+
+    def done(self, stage, inputs, params, outputs):
+        """Write the marker of stage. Called only once the stage returned, a
+        failed stage raises before and keeps no marker"""
+
+        missing = [x for x in outputs if not os.path.isfile(x)]
+        if missing:
+            raise SystemExit(f"{stage} did not write {' '.join(missing)}")
+        tmp = f"{self.path(stage)}.tmp"
+        with open(tmp, "w") as h:
+            json.dump(self.marker(stage, inputs, params, outputs), h, indent=1)
+        os.replace(tmp, self.path(stage))
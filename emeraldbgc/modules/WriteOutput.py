@@ -14,13 +14,9 @@
 import json
 import logging
 import os
-import pickle
+from heapq import merge
 from itertools import groupby
 
-import numpy as np
-import tensorflow as tf
-from joblib import load
-
 from emeraldbgc import __version__
 from emeraldbgc import _info
 log = logging.getLogger(f"EMERALD.{__name__}")
@@ -28,19 +24,28 @@ log = logging.getLogger(f"EMERALD.{__name__}")
 
 class Outputs:
 
-    """ write results in file """
+    """ write results in file.
+
+    The GFF3 is built from (start, sort type, end, feature type,
+    attributes) records, emitted per contig in contig name order. With
+    stream True it is written incrementally: writeContigs appends the
+    contigs given (in contig name order across calls) and close finishes
+    the output. self.clusters keeps the CLUSTER records of every contig
+    for the antiSMASH JSON """
 
-    def __init__(self, obj, minimal_output, cli_args, refined_borders, outfile):
+    def __init__(self, obj, minimal_output, cli_args, refined_borders, outfile, stream=False):
         self.annotation = obj
         self.minimal = minimal_output
         self.cli_args = cli_args
         self.ref_b = refined_borders
         self.outfile = outfile
-        self.gff3 = []
-        self.clusts = []
-        self.writeGff3()
-        if self.cli_args.antismash_out != "False":
-            self.writeAntismashJson()
+        self.clusters = {}
+        if stream:
+            self.open()
+        else:
+            self.writeGff3()
+            if self.cli_args.antismash_out != "False":
+                self.writeAntismashJson()
 
     def writeAntismashJson(self):
         
@@ -55,32 +60,18 @@ class Outputs:
         }
         
         ### records section
-        # f"{contig}\tEMERALDv{__version__}\tCLUSTER_border\t{start}\t{end}\t.\t.\t.\tID={ID}_{ct2};{typs};partial={edge}"
-        records = {}
-        for l in self.gff3:
-            if "CLUSTER_border" in l:
-                continue
-            spl = l.split("\t")
-            contig, start, end, annot = [spl[x] for x in [0,3,4,8]]
-            records.setdefault(spl[0],[]).append({
-                "start":int(start),
-                "end":int(end),
-                "label":annot.split(";")[0].split("=")[-1],
-                "details":{
-                    "score":annot.split(";")[4].split("=")[-1],
-                    "class":annot.split(";")[2].split("=")[-1]
-                }
-            })
-        for contig,bgcs in records.items():
+        for contig, bgcs in self.clusters.items():
             dct = {}
             dct["name"] = contig
-            for bgc in bgcs:
+            for ID, start, end, (mibig, cla, dist, score) in bgcs:
                 dct.setdefault("subregions",[]).append({
-                    "start":bgc["start"],
-                    "end":bgc["end"],
-                    "label":bgc["label"],
-                    "deteils":bgc["details"],
-                    
+                    "start":int(start),
+                    "end":int(end),
+                    "label":ID,
+                    "deteils":{
+                        "score":"{:.3f}".format(score),
+                        "class":cla,
+                    },
                 })
             self.asj["records"].append(dct)
             
@@ -91,100 +82,91 @@ class Outputs:
     def writeGff3(self):
 
         log.info("build GFF3")
-        log.info(self.outfile)
-        type_code = {
-            0: "Alkaloid",
-            1: "NRP",
-            2: "Polyketide",
-            3: "RiPP",
-            4: "Saccharide",
-            5: "Terpene",
-            6: "Other",
-        }
+        self.open()
+        self.writeContigs(self.annotation.looseClst)
+        self.handle.close()
 
-        for contig in self.annotation.looseClst:
-
-            if self.minimal != "True":
-                for ix, f in enumerate(self.annotation.contigsDct[contig]):
-
-                    ID, (start, end) = f
-                    emrldProb = "{:.3f}".format(self.annotation.annResults[contig][ix])
-                    self.gff3.append(
-                        f"{contig}\tEMERALDv{__version__}\tCDS\t{start}\t{end}\t.\t.\t.\tID={ID};emerald_probability={emrldProb}"
-                    )
-
-            ct = 1
-            for k, g in groupby(
-                enumerate(
-                    self.annotation.looseClst[contig][
-                        : len(self.annotation.contigsDct[contig])
-                    ]
-                ),
-                key=lambda x: x[1],
-            ):
-
-                if k == 0:
-                    continue
-
-                ID = f"{contig}_emrld_{ct}"
-                ct += 1
-
-                gg = list(list(zip(*g))[0])
-
-                start, end = (
-                    self.annotation.contigsDct[contig][gg[0]][1][0],
-                    self.annotation.contigsDct[contig][gg[-1]][1][1],
-                )
-
-                edge = "{}{}".format(
-                    1 if gg[0] == 0 else 0,
-                    1 if gg[-1] == len(self.annotation.contigsDct[contig]) - 1 else 0,
-                )
-
-                typs = self.annotation.typesClst[contig][gg[0]]
-                # typs = "nearest_MiBIG={};nearest_MiBIG_class={};nearest_MiBIG_jacardDistance={}".format(typs[0],typs[1],typs[2])
-                self.gff3.append(
-                    f"{contig}\tEMERALDv{__version__}\tCLUSTER\t{start}\t{end}\t.\t.\t.\tID={ID};{typs};partial={edge}"
-                )
-
-                if self.ref_b == "True":
-
-                    ct2 = 1
-                    for k2, g2 in groupby(
-                        zip(gg, self.annotation.borderClst[contig][gg]),
-                        key=lambda x: x[1],
-                    ):
-                        if k2 == 0:
-                            continue
-                        gg2 = list(list(zip(*g2))[0])
-                        start, end = (
-                            self.annotation.contigsDct[contig][gg2[0]][1][0],
-                            self.annotation.contigsDct[contig][gg2[-1]][1][1],
-                        )
-                        edge = "{}{}".format(
-                            1 if gg[0] == 0 else 0,
-                            1
-                            if gg[-1] == len(self.annotation.contigsDct[contig]) - 1
-                            else 0,
-                        )
-
-                        self.gff3.append(
-                            f"{contig}\tEMERALDv{__version__}\tCLUSTER_border\t{start}\t{end}\t.\t.\t.\tID={ID}_{ct2};{typs};partial={edge}"
-                        )
-                        ct2 += 1
+    def open(self):
 
         log.info(f"Writing output to file {self.outfile}")
-        with open(self.outfile, "w") as h:
+        self.handle = open(self.outfile, "w", buffering=1 << 20)
+        self.handle.write("##gff-version 3\n")
 
-            h.write("##gff-version 3\n")
+    def close(self):
 
-            key = lambda x: (
-                x.split("\t")[0],
-                int(x.split("\t")[3]),
-                "Z" if x.split("\t")[2] == "CDS" else x.split("\t")[2],
+        self.handle.close()
+        if self.cli_args.antismash_out != "False":
+            self.writeAntismashJson()
+
+    def writeContigs(self, contigs):
+        """Write the GFF3 lines of contigs, in contig name order"""
+
+        source = f"EMERALDv{__version__}"
+        for contig in sorted(contigs):
+            self.handle.writelines(
+                f"{contig}\t{source}\t{ftype}\t{start}\t{end}\t.\t.\t.\t{attributes}\n"
+                for start, key, end, ftype, attributes in self.contigRecords(contig)
             )
-            
-            self.gff3 = sorted(self.gff3, key=key)
-            for l in self.gff3:
 
-                h.write(f"{l}\n")
+    def contigRecords(self, contig):
+        """GFF3 records of contig ordered by start, clusters before CDS.
+
+        The CDS records come sorted from contigsDct and are merged with
+        the few cluster records"""
+
+        cdss = self.annotation.contigsDct[contig]
+        clusters = sorted(self.clusterRecords(contig), key=lambda x: x[:2])
+        if self.minimal == "True":
+            return clusters
+
+        probs = self.annotation.annResults[contig]
+        cdsRecs = [
+            (int(start), "Z", end, "CDS", "ID={};emerald_probability={:.3f}".format(ID, probs[ix]))
+            for ix, (ID, (start, end)) in enumerate(cdss)
+        ]
+        if any(cdsRecs[i][0] > cdsRecs[i + 1][0] for i in range(len(cdsRecs) - 1)):
+            cdsRecs.sort(key=lambda x: x[0])
+        return merge(clusters, cdsRecs, key=lambda x: x[:2])
+
+    def clusterRecords(self, contig):
+        """CLUSTER and CLUSTER_border records of contig, in calling order.
+        The CLUSTER records are also kept in self.clusters"""
+
+        cdss = self.annotation.contigsDct[contig]
+        nCds = len(cdss)
+        types = self.annotation.clstTypes[contig]
+        records, ct = [], 1
+        for clStart, clEnd in self.annotation.clstIntervals[contig]:
+
+            if clStart >= nCds:
+                continue
+
+            ID = f"{contig}_emrld_{ct}"
+            ct += 1
+
+            gg = list(range(clStart, min(clEnd, nCds)))
+            start, end = cdss[gg[0]][1][0], cdss[gg[-1]][1][1]
+            edge = "{}{}".format(1 if gg[0] == 0 else 0, 1 if gg[-1] == nCds - 1 else 0)
+
+            typs = self.annotation.typesClst[contig][gg[0]]
+            records.append((int(start), "CLUSTER", end, "CLUSTER", f"ID={ID};{typs};partial={edge}"))
+            self.clusters.setdefault(contig, []).append((ID, start, end, types[gg[0]]))
+
+            if self.ref_b == "True":
+
+                ct2 = 1
+                for k2, g2 in groupby(
+                    zip(gg, self.annotation.borderClst[contig][gg]),
+                    key=lambda x: x[1],
+                ):
+                    if k2 == 0:
+                        continue
+                    gg2 = list(list(zip(*g2))[0])
+                    bStart, bEnd = cdss[gg2[0]][1][0], cdss[gg2[-1]][1][1]
+                    records.append((
+                        int(bStart), "CLUSTER_border", bEnd, "CLUSTER_border",
+                        f"ID={ID}_{ct2};{typs};partial={edge}",
+                    ))
+                    ct2 += 1
+
+        return records
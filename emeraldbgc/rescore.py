@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Re-score an emeraldbgc run saved with --checkpoint True.
+
+The per-CDS probabilities are reloaded, so only the clusters, the type
+classification and the outputs are computed again, without InterProScan,
+hmmscan or the BGC model. One GFF3 is written per --score / --greed value:
+
+    emerald_rescore --greed 0 --greed 2 --score 0.6 OUTFILE.checkpoint.npz
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from emeraldbgc import __version__
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+log = logging.getLogger("EMERALD.rescore")
+
+CHECKPOINT_EXT = ".checkpoint.npz"
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(
+        description="emerald_rescore. Recompute EMERALD clusters from a checkpoint for other thresholds"
+    )
+    parser.add_argument(
+        "checkpoint",
+        type=str,
+        help="emeraldbgc checkpoint, OUTFILE.checkpoint.npz",
+        metavar="CHECKPOINT",
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        help="Show the version number and exit.",
+        version=f"EMERALD {__version__}",
+    )
+    parser.add_argument(
+        "--greed",
+        dest="greed",
+        default=[],
+        action="append",
+        type=int,
+        help="Level of greediness, 0,1,2. Repeat for several levels [default 1 when no --score]",
+        metavar="INT",
+    )
+    parser.add_argument(
+        "--score",
+        dest="score",
+        default=[],
+        action="append",
+        type=float,
+        help="validation filter threshold. Repeat for several thresholds",
+        metavar="FLOAT",
+    )
+    parser.add_argument(
+        "--outdir",
+        dest="outdir",
+        default=None,
+        type=str,
+        help="output directory [default CHECKPOINT directory]",
+        metavar="DIRECTORY",
+    )
+    parser.add_argument(
+        "--minimal",
+        dest="minimal_out",
+        default="True",
+        type=str,
+        help="minimal output in a gff3 file [default True]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--antismash_output",
+        dest="antismash_out",
+        default="False",
+        type=str,
+        help="write results in antiSMASH 6.0 JSON specification output [default False]",
+        metavar="True|False",
+    )
+    parser.add_argument(
+        "--refined",
+        dest="ref_b",
+        default="False",
+        type=str,
+        help="annotate high probability borders [default False]",
+        metavar="True|False",
+    )
+    args = parser.parse_args(args)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+
+    from modules.BGCdetection import AnnotationFilesToEmerald
+    from modules.WriteOutput import Outputs
+
+    base = os.path.basename(args.checkpoint)
+    base = base[: -len(CHECKPOINT_EXT)] if base.endswith(CHECKPOINT_EXT) else base
+    base = base[:-4] if base.endswith(".gff") else base
+    outdir = args.outdir if args.outdir else os.path.dirname(os.path.abspath(args.checkpoint))
+    os.makedirs(outdir, exist_ok=True)
+
+    annotate = AnnotationFilesToEmerald()
+    meta = annotate.loadCheckpoint(args.checkpoint)
+    log.info(f"{args.checkpoint}: {len(annotate.contigsDct)} contigs")
+
+    thresholds = [(None, g) for g in args.greed] + [(s, 1) for s in args.score]
+    for score, greed in thresholds if thresholds else [(None, 1)]:
+        annotate.defineLooseClusters(score=score, g=greed)
+        annotate.predictType()
+        tag = f"greed{greed}" if score is None else f"score{score}"
+        outfile = os.path.join(outdir, f"{base}.{tag}.gff")
+        Outputs(
+            annotate,
+            args.minimal_out,
+            argparse.Namespace(antismash_out=args.antismash_out, greed=greed, meta=meta),
+            args.ref_b,
+            outfile,
+        )
+        print(f"{tag}: {sum(len(x) for x in annotate.clstIntervals.values())} clusters, {outfile}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
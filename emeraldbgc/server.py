@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Long-lived EMERALD detection worker.
+
+The BGC model, vocabulary, type models and MIBiG domains are loaded once,
+then every request runs the detection on an annotation files triple.
+
+Protocol: one JSON object per line, answered with one JSON line.
+    request:  {"ips_file": ..., "hmm_file": ..., "cds_file": ...,
+               "fmt": "fasta"|"genbank"|"cds_table", "outfile": ..., "args": {...}}
+    response: {"status": "ok", "outfile": ...}
+              {"status": "error", "error": ...}
+"args" takes the emeraldbgc detection options (score, greed, minimal_out,
+antismash_out, ref_b, meta, batch_size, chunk_size,
+checkpoint), defaulting to the CLI defaults.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+from contextlib import nullcontext, redirect_stdout
+
+log = logging.getLogger("EMERALD.server")
+
+DEFAULT_ARGS = {
+    "score": None,
+    "greed": 1,
+    "minimal_out": "True",
+    "antismash_out": "False",
+    "ref_b": "False",
+    "meta": "True",
+    "batch_size": None,
+    "chunk_size": None,
+    "checkpoint": "False",
+}
+
+
+def runRequest(annotate, line):
+    """Run one JSON request line, returns the JSON response line"""
+
+    from emeraldbgc._cli import detect
+
+    try:
+        request = json.loads(line)
+        args = argparse.Namespace(**{**DEFAULT_ARGS, **request.get("args", {})})
+        log.info(f"request {request['outfile']}")
+        detect(
+            annotate,
+            request["ips_file"],
+            request["hmm_file"],
+            request["cds_file"],
+            request["fmt"],
+            args,
+            request["outfile"],
+        )
+        response = {"status": "ok", "outfile": request["outfile"]}
+    except Exception as err:
+        log.exception(err)
+        response = {"status": "error", "error": f"{type(err).__name__}: {err}"}
+    return json.dumps(response) + "\n"
+
+
+def submit(socketPath, request):
+    """Send a request to a running server and wait for its response"""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall((json.dumps(request) + "\n").encode("utf8"))
+        with sock.makefile("r") as h:
+            response = json.loads(h.readline())
+    if response["status"] != "ok":
+        log.error(response["error"])
+        raise SystemExit(f"EMERALD server error: {response['error']}")
+    return response
+
+
+def main(args=None):
+
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from modules.Inference import MODEL_FILES
+
+    parser = argparse.ArgumentParser(
+        description="emerald_server. Keep EMERALD models loaded and run detection requests"
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        default=None,
+        type=str,
+        help="unix socket to listen on. Without it, requests are read from stdin and answered on stdout",
+        metavar="SOCKET",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="keras",
+        type=str,
+        choices=list(MODEL_FILES),
+        help="BGC model inference backend [default keras]",
+        metavar="keras|onnx|tflite",
+    )
+    parser.add_argument(
+        "--log",
+        dest="log",
+        default=None,
+        type=str,
+        help="log file [default stderr]",
+        metavar="FILE",
+    )
+    args = parser.parse_args(args)
+
+    logging.basicConfig(
+        filename=args.log,
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    logging.captureWarnings(True)
+
+    from modules.BGCdetection import AnnotationFilesToEmerald
+
+    # in stdin mode stdout carries the responses only, any other output
+    # (e.g. a progress bar of the inference backend) goes to stderr
+    responses = sys.stdout
+    with redirect_stdout(sys.stderr) if not args.socket else nullcontext():
+        log.info("loading models")
+        annotate = AnnotationFilesToEmerald(backend=args.backend)
+        annotate.loadModel()
+
+        if not args.socket:
+            for line in sys.stdin:
+                if line.strip():
+                    responses.write(runRequest(annotate, line))
+                    responses.flush()
+            return
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(runRequest(annotate, line.decode("utf8")).encode("utf8"))
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with socketserver.UnixStreamServer(args.socket, Handler) as server:
+        log.info(f"listening on {args.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
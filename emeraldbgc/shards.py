@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Scatter / gather of one large assembly across nodes.
+
+scatter splits the sequence file by contig in shards of similar size, each
+in its own directory, and writes SCATTER_DIR/commands.txt with one
+emeraldbgc command per shard (e.g. for a job array). The options after --
+are passed to every emeraldbgc run:
+
+    emerald_shards scatter soil.fna --shards 100 --outdir work -- --antismash_output True
+    sed -n "${SLURM_ARRAY_TASK_ID}p" work/commands.txt | sh
+    emerald_shards gather work
+
+gather merges the GFF3 and antiSMASH JSON of the shards, in contig name
+order, into the output of a single run. The detection is per contig, so
+the results (and the {contig}_emrld_{n} cluster IDs) do not depend on the
+partition. prodigal must run in meta mode, where every contig is also
+predicted independently.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import shlex
+import sys
+from itertools import groupby
+
+from emeraldbgc import __version__
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+SCATTER_FILE = "scatter.json"
+# emeraldbgc options set by scatter for every shard
+RESERVED = ["outdir", "outfile", "server"]
+
+
+def readRecords(seq_file, fmt):
+    """Stream the (residues, lines) records of a FASTA or GenBank file"""
+
+    with open(seq_file, "r") as h:
+        lines, size, origin = [], 0, False
+        for l in h:
+            if fmt == "fasta":
+                if l[0] == ">" and lines:
+                    yield size, lines
+                    lines, size = [], 0
+                elif l[0] != ">":
+                    size += len(l.strip())
+                lines.append(l)
+            else:
+                if not lines and not l.strip():
+                    continue
+                lines.append(l)
+                if l[:2] == "//":
+                    yield size, lines
+                    lines, size, origin = [], 0, False
+                elif origin:
+                    size += len("".join(l.split()[1:]))
+                elif l[:6] == "ORIGIN":
+                    origin = True
+        if lines:
+            yield size, lines
+
+
+def scatter(seq_file, fmt, nShards, outdir, emeraldArgs):
+    """Distribute the contigs of seq_file in nShards files, each record to
+    the shard with the fewest residues. Returns the scatter description"""
+
+    base = os.path.basename(seq_file)
+    shards = []
+    for i in range(nShards):
+        shardDir = os.path.join(outdir, f"shard{i:04d}")
+        name = f"shard{i:04d}_{base}"
+        shards.append(
+            {
+                "seq_file": os.path.join(shardDir, name),
+                "outdir": shardDir,
+                "outfile": os.path.join(shardDir, f"{name}.emerald.full.gff"),
+                "contigs": 0,
+                "residues": 0,
+            }
+        )
+
+    handles = {}
+    loads = [(0, i) for i in range(nShards)]
+    try:
+        for size, lines in readRecords(seq_file, fmt):
+            load, i = heapq.heappop(loads)
+            if i not in handles:
+                os.makedirs(shards[i]["outdir"], exist_ok=True)
+                handles[i] = open(shards[i]["seq_file"], "w", buffering=1 << 20)
+            handles[i].writelines(lines)
+            shards[i]["contigs"] += 1
+            shards[i]["residues"] += size
+            heapq.heappush(loads, (load + size, i))
+    finally:
+        for h in handles.values():
+            h.close()
+
+    shards = [x for x in shards if x["contigs"]]
+    for shard in shards:
+        shard["command"] = shlex.join(
+            ["emeraldbgc", shard["seq_file"], "--outdir", shard["outdir"], "--outfile", shard["outfile"]]
+            + emeraldArgs
+        )
+    return {
+        "version": __version__,
+        "seq_file": seq_file,
+        "format": fmt,
+        "emeraldbgc_args": emeraldArgs,
+        "shards": shards,
+    }
+
+
+def contigBlocks(gff):
+    """(contig, lines) of a GFF3 written by emeraldbgc, in file order"""
+
+    with open(gff, "r") as h:
+        for contig, lines in groupby(
+            (l for l in h if l[0] != "#"), key=lambda l: l.split("\t", 1)[0]
+        ):
+            yield contig, list(lines)
+
+
+def gatherGff(gffs, outfile):
+    """Merge the contig name ordered GFF3 files of the shards"""
+
+    with open(outfile, "w", buffering=1 << 20) as h:
+        h.write("##gff-version 3\n")
+        for contig, lines in heapq.merge(*[contigBlocks(x) for x in gffs], key=lambda x: x[0]):
+            h.writelines(lines)
+
+
+def gatherAntismash(jsons, outfile):
+    """Merge the antiSMASH JSON records of the shards by contig name"""
+
+    tool, records = None, []
+    for f in jsons:
+        with open(f, "r") as h:
+            asj = json.load(h)
+        tool = tool if tool else asj["tool"]
+        records.extend(asj["records"])
+    with open(outfile, "w") as h:
+        json.dump({"tool": tool, "records": sorted(records, key=lambda x: x["name"])}, h)
+
+
+def gather(scatterDir, outfile=None):
+    """Merge the outputs of the shards of scatterDir. Returns the GFF3 file"""
+
+    with open(os.path.join(scatterDir, SCATTER_FILE), "r") as h:
+        desc = json.load(h)
+    shards = desc["shards"]
+    missing = [x["outfile"] for x in shards if not os.path.isfile(x["outfile"])]
+    if missing:
+        raise SystemExit(f"{len(missing)} of {len(shards)} shards without output: {' '.join(missing)}")
+
+    outfile = (
+        outfile
+        if outfile
+        else os.path.join(scatterDir, f"{os.path.basename(desc['seq_file'])}.emerald.full.gff")
+    )
+    gatherGff([x["outfile"] for x in shards], outfile)
+
+    jsons = [f"{x['outfile']}.antismash.json" for x in shards]
+    found = [os.path.isfile(x) for x in jsons]
+    if any(found) and not all(found):
+        raise SystemExit("antiSMASH JSON missing in some shards")
+    if all(found):
+        gatherAntismash(jsons, f"{outfile}.antismash.json")
+    return outfile
+
+
+def main(args=None):
+
+    args = sys.argv[1:] if args is None else list(args)
+    emeraldArgs = args[args.index("--") + 1 :] if "--" in args else []
+    args = args[: args.index("--")] if "--" in args else args
+
+    parser = argparse.ArgumentParser(
+        description="emerald_shards. Split one large sequence file by contig across nodes and merge the results"
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        help="Show the version number and exit.",
+        version=f"EMERALD {__version__}",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sc = sub.add_parser(
+        "scatter",
+        help="split SEQUENCE_FILE in shards. emeraldbgc options go after --",
+    )
+    sc.add_argument(
+        "seq_file",
+        type=str,
+        help="input nucleotide sequence file. FASTA or GBK",
+        metavar="SEQUENCE_FILE",
+    )
+    sc.add_argument(
+        "--shards",
+        dest="shards",
+        required=True,
+        type=int,
+        help="number of shards",
+        metavar="INT",
+    )
+    sc.add_argument(
+        "--outdir",
+        dest="outdir",
+        default=None,
+        type=str,
+        help="scatter directory, on a filesystem shared by the nodes [default $PWD/SEQUENCE_FILE.emerald_shards]",
+        metavar="DIRECTORY",
+    )
+
+    ga = sub.add_parser("gather", help="merge the shard outputs of a scatter directory")
+    ga.add_argument(
+        "scatter_dir",
+        type=str,
+        help="scatter directory",
+        metavar="DIRECTORY",
+    )
+    ga.add_argument(
+        "--outfile",
+        dest="outfile",
+        default=None,
+        type=str,
+        help="output file [default DIRECTORY/SEQUENCE_FILE.emerald.full.gff]",
+        metavar="FILE",
+    )
+    args = parser.parse_args(args)
+
+    if args.command == "gather":
+        print(f"gathered: {gather(args.scatter_dir, args.outfile)}")
+        return
+
+    from emeraldbgc._cli import argParser
+
+    # the emeraldbgc options as the shard runs will read them
+    cli = argParser()
+    shardArgs = cli.parse_args([args.seq_file] + emeraldArgs)
+    reserved = [f"--{x}" for x in RESERVED if getattr(shardArgs, x) != cli.get_default(x)]
+    if reserved:
+        parser.error(f"{' '.join(reserved)} set by scatter for every shard")
+    if shardArgs.meta != "True":
+        parser.error("scatter requires prodigal meta mode, the default --meta True")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+
+    from modules.Preproc import Preprocess
+
+    seq_file = os.path.abspath(args.seq_file)
+    outdir = os.path.abspath(
+        args.outdir if args.outdir else f"{os.path.basename(seq_file)}.emerald_shards"
+    )
+    os.makedirs(outdir, exist_ok=True)
+    preprocess = Preprocess(seq_file, None, "True", 1, outdir)
+    preprocess.check_fmt()
+
+    desc = scatter(seq_file, preprocess.fmt, args.shards, outdir, emeraldArgs)
+    with open(os.path.join(outdir, SCATTER_FILE), "w") as h:
+        json.dump(desc, h, indent=1)
+    with open(os.path.join(outdir, "commands.txt"), "w") as h:
+        h.writelines(f"{x['command']}\n" for x in desc["shards"])
+    print(
+        f"{sum(x['contigs'] for x in desc['shards'])} contigs in {len(desc['shards'])} shards, "
+        f"commands in {os.path.join(outdir, 'commands.txt')}"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -37,6 +37,11 @@ setup(
             'console_scripts': [
                                 'emeraldbgc = emeraldbgc._cli:main',
                                 'emerald_build_gb = emeraldbgc.build_gb:main',
+                                'emerald_server = emeraldbgc.server:main',
+                                'emerald_batch = emeraldbgc.batch:main',
+                                'emerald_export_model = emeraldbgc.export_model:main',
+                                'emerald_rescore = emeraldbgc.rescore:main',
+                                'emerald_shards = emeraldbgc.shards:main',
                                 ]
     },
     packages = find_packages(exclude=('tests', 'docs')),
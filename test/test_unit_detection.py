@@ -1,6 +1,7 @@
 import os
 import sys
 import filecmp
+import json
 import pytest
 import emeraldbgc
 import numpy as np
@@ -8,6 +9,7 @@ import numpy as np
 emrld_dir = os.path.dirname(os.path.abspath(emeraldbgc.__file__))
 test_files_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
 modules_dir = os.path.join(emrld_dir, "modules")
+sys.path.append(emrld_dir)
 sys.path.append(modules_dir)
 
 from BGCdetection import AnnotationFilesToEmerald
@@ -37,3 +39,119 @@ def test_bgc_prediction():
     ann.predictType()
     assert np.array_equal(np.where(ann.typesClst['BGC0001472']!=None)[0], np.array([ 0,  1,  2,  3,  4,  5,  6,  7,  8,  9, 10, 11, 12, 13, 14, 15]))
 
+
+def test_project_res_interpolation():
+
+    ann = AnnotationFilesToEmerald.__new__(AnnotationFilesToEmerald)
+    res = np.array([0.2, 0.9, 0.4, 0.6], dtype=np.float32)
+    ixes = np.array([1, 2, 5, 9])
+
+    expected = np.zeros(12)
+    expected[ixes] = res
+    prev, rprev = 0, 0
+    for ix, r in zip(ixes, res):
+        if ix - 1 == prev:
+            prev, rprev = ix, r
+            continue
+        for ixx, s in list(enumerate(np.linspace(rprev, r, ix - prev + 1)))[1:-1]:
+            expected[prev + ixx] = s
+        prev = ix
+
+    assert np.array_equal(ann.projectRes(res, ixes, 12), expected)
+
+def test_cluster_intervals_with_bounds():
+
+    ann = AnnotationFilesToEmerald.__new__(AnnotationFilesToEmerald)
+    vec = np.array([1, 1, 0, 1, 1, 1, 1, 0, 0, 0, 0, 1])
+    bounds = np.array([5])
+
+    filled = ann.fillGap(vec, 2, bounds)
+    assert list(filled) == [1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 1]
+    loose = ann.rmLessThan(filled, 2, bounds)
+    assert list(loose) == [1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+    assert ann.callIntervals(loose, bounds).tolist() == [[0, 5]]
+
+@pytest.mark.parametrize("backend", ["onnx", "tflite"])
+def test_backend_parity(backend):
+
+    from Inference import modelFile
+
+    pytest.importorskip("tensorflow")
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+    for f in ["keras", backend]:
+        if not os.path.isfile(modelFile(f)):
+            pytest.skip(f"{modelFile(f)} not found")
+
+    results = []
+    for b in ["keras", backend]:
+        ann = AnnotationFilesToEmerald(backend=b)
+        ann.transformIPS(os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.ip.tsv"))
+        ann.transformEmeraldHmm(os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.emerald.tsv"))
+        ann.transformCDSpredToCDScontigs(os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa"), "fasta")
+        ann.buildMatrices()
+        ann.predictAnn()
+        results.append(ann.annResults['BGC0001472'])
+
+    assert len(results[0]) and np.any(results[0])
+    assert np.allclose(results[0], results[1], atol=1e-5)
+
+def test_gff3_record_order(tmp_path):
+
+    import argparse
+    from types import SimpleNamespace
+    from WriteOutput import Outputs
+
+    cdss = [(f"c_{i}", (i * 100 + 1, i * 100 + 90)) for i in range(6)]
+    ann = SimpleNamespace(
+        contigsDct={"b": cdss, "a": cdss[:3]},
+        annResults={"b": np.linspace(0, 1, 6), "a": np.zeros(3)},
+        clstIntervals={"b": np.array([[1, 4]]), "a": np.zeros((0, 2), dtype=int)},
+        clstTypes={"b": {1: ("BGC0000001", "NRP", 0.5, 0.9)}, "a": {}},
+        typesClst={"b": np.array([None, "t", "t", "t", None, None], dtype=object), "a": np.empty(3, dtype=object)},
+        borderClst={"b": np.array([0, 1, 1, 0, 0, 0]), "a": np.zeros(3, dtype=int)},
+        looseClst={"b": None, "a": None},
+    )
+    args = argparse.Namespace(antismash_out="True", greed=1, meta="True")
+    outfile = str(tmp_path / "out.gff")
+    Outputs(ann, "False", args, "True", outfile)
+
+    lines = [l.split("\t") for l in open(outfile) if l[0] != "#"]
+    assert [(l[0], l[2], l[3]) for l in lines[3:7]] == [
+        ("b", "CDS", "1"), ("b", "CLUSTER", "101"), ("b", "CLUSTER_border", "101"), ("b", "CDS", "101")
+    ]
+    assert [l[0] for l in lines[:3]] == ["a"] * 3
+    record = json.load(open(f"{outfile}.antismash.json"))["records"]
+    assert record == [{"name": "b", "subregions": [
+        {"start": 101, "end": 390, "label": "b_emrld_1", "deteils": {"score": "0.900", "class": "NRP"}}
+    ]}]
+
+def test_checkpoint_roundtrip(tmp_path):
+
+    from array import array
+
+    ann = AnnotationFilesToEmerald.__new__(AnnotationFilesToEmerald)
+    ann.reset()
+    ann.vocab = {f"PF{i}": i for i in range(10)}
+    ann.contigsDct = {
+        "c1": [("p1", (1, 90)), ("p2", (100, 190))],
+        "c2": [("p3", (5, 50))],
+    }
+    ann.entriesDct = {"p1": array("i", [1, 4]), "p3": array("i", [9])}
+    ann.buildMatrices()
+    ann.annResults = {c: np.zeros(m.shape[0]) for c, m in ann.annDct.items()}
+    for c, cdss in ann.contigsDct.items():
+        ann.annResults[c][: len(cdss)] = np.random.default_rng(0).random(len(cdss))
+
+    path = str(tmp_path / "run.checkpoint.npz")
+    parts = [ann.saveCheckpointPart(str(tmp_path / f"part{c}.npz"), [c]) for c in ["c1", "c2"]]
+    ann.saveCheckpoint(path, parts, "False")
+    assert not any(os.path.exists(x) for x in parts)
+
+    new = AnnotationFilesToEmerald.__new__(AnnotationFilesToEmerald)
+    new.vocab = ann.vocab
+    assert new.loadCheckpoint(path) == "False"
+    assert new.contigsDct == ann.contigsDct
+    for c in ann.contigsDct:
+        assert (new.annDct[c] != ann.annDct[c]).nnz == 0
+        assert np.array_equal(new.annResults[c], ann.annResults[c])
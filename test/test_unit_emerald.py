@@ -5,3 +5,154 @@ def testCliHelp():
     with pytest.raises(SystemExit) as e:
         _cli.main(['--help'])
     assert e.value.code == 0
+
+def testBatchSplitAnnotation():
+    import os
+    import tempfile
+    from emeraldbgc import batch
+
+    test_files_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
+    faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+    hmm_file = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.emerald.tsv")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        joined = os.path.join(tmpdir, "batch.faa")
+        batch.joinProteins([(0, faa), (1, faa)], joined)
+        assert sum(l.startswith(">g1_") for l in open(joined)) == sum(l[0] == ">" for l in open(faa))
+
+        hits = [l.split(maxsplit=22) for l in open(hmm_file) if l[0] != "#"]
+        with open(os.path.join(tmpdir, "batch.tsv"), "w") as h:
+            for i in range(2):
+                for spl in hits:
+                    h.write(" ".join(spl[:3] + [f"g{i}_{spl[3]}"] + spl[4:]))
+        outs = {i: os.path.join(tmpdir, f"{i}.tsv") for i in range(2)}
+        batch.splitAnnotation(os.path.join(tmpdir, "batch.tsv"), outs, None, 3)
+        for i in range(2):
+            assert [l.split(maxsplit=22) for l in open(outs[i])] == hits
+
+def testRunReport(tmp_path):
+    import json
+    import subprocess
+    import sys
+    from modules.RunReport import RunReport
+
+    report = RunReport(str(tmp_path / "emerald.report.json"), {"cpu": 1})
+    for n in [3, 4]:
+        with report.stage("step") as counts:
+            subprocess.run([sys.executable, "-c", "pass"])
+            counts["contigs"] = n
+    report.write()
+
+    res = json.load(open(tmp_path / "emerald.report.json"))
+    assert res["args"] == {"cpu": 1}
+    assert res["stages"]["step"]["calls"] == 2
+    assert res["stages"]["step"]["counts"] == {"contigs": 7}
+    assert res["stages"]["step"]["children_cpu_s"] > 0
+
+def testProfilerStage(tmp_path):
+    import pstats
+    import time
+    from modules.Profiler import Profiler
+    from modules.RunReport import RunReport
+
+    def slowStage():
+        time.sleep(0.1)
+
+    profiler = Profiler(str(tmp_path / "emerald.profile.slow"), "slow")
+    report = RunReport(profiler=profiler)
+    with report.stage("fast"):
+        time.sleep(0.05)
+    with report.stage("slow"):
+        slowStage()
+    profiler.write()
+
+    functions = [f[2] for f in pstats.Stats(str(tmp_path / "emerald.profile.slow.pstats")).stats]
+    assert "slowStage" in functions
+    stacks = open(tmp_path / "emerald.profile.slow.collapsed").read()
+    assert "slowStage" in stacks
+
+def testShardsScatterGather(tmp_path):
+    from emeraldbgc import shards
+
+    seq = tmp_path / "asm.fna"
+    seq.write_text("".join(f">c{i}\n{'A' * (i + 1) * 10}\n" for i in range(7)))
+    desc = shards.scatter(str(seq), "fasta", 3, str(tmp_path / "sc"), ["--greed", "2"])
+    assert sum(x["contigs"] for x in desc["shards"]) == 7
+    assert sorted(l for x in desc["shards"] for l in open(x["seq_file"])) == sorted(open(seq))
+    assert desc["shards"][0]["command"].endswith("--greed 2")
+
+    gffs = []
+    for x in desc["shards"]:
+        contigs = sorted(l[1:].strip() for l in open(x["seq_file"]) if l[0] == ">")
+        with open(x["outfile"], "w") as h:
+            h.write("##gff-version 3\n")
+            h.writelines(f"{c}\tEMERALD\tCDS\t{k}\t9\t.\t.\t.\tID={c}_{k}\n" for c in contigs for k in [1, 5])
+    out = tmp_path / "merged.gff"
+    shards.gatherGff([x["outfile"] for x in desc["shards"]], str(out))
+    lines = open(out).readlines()
+    assert lines[0] == "##gff-version 3\n"
+    assert [l.split("\t")[0] for l in lines[1:]] == [f"c{i}" for i in range(7) for k in [1, 5]]
+
+def testServerStdinJsonLines(monkeypatch, capsys):
+    import io
+    import json
+    from emeraldbgc import _cli, server
+    import modules.BGCdetection
+
+    class Annotate:
+        def __init__(self, backend):
+            pass
+
+        def loadModel(self):
+            print("loading 1/1")
+
+    def detect(*args):
+        print("1/1 [==============================] - 0s")
+
+    monkeypatch.setattr(modules.BGCdetection, "AnnotationFilesToEmerald", Annotate)
+    monkeypatch.setattr(_cli, "detect", detect)
+    request = {"ips_file": "a", "hmm_file": "b", "cds_file": "c", "fmt": "fasta", "outfile": "o"}
+    monkeypatch.setattr("sys.stdin", io.StringIO(json.dumps(request) + "\nnot json\n"))
+    server.main([])
+
+    captured = capsys.readouterr()
+    responses = [json.loads(l) for l in captured.out.splitlines()]
+    assert [x["status"] for x in responses] == ["ok", "error"]
+    assert "[=====" in captured.err
+
+def testRescoreThresholds(monkeypatch, capsys):
+    from emeraldbgc import rescore
+    import modules.BGCdetection
+    import modules.WriteOutput
+
+    calls = []
+
+    class Annotate:
+        contigsDct, clstIntervals = {}, {}
+
+        def loadCheckpoint(self, path):
+            calls.append(path)
+            return "True"
+
+        def defineLooseClusters(self, score, g):
+            calls.append((score, g))
+
+        def predictType(self):
+            pass
+
+    monkeypatch.setattr(modules.BGCdetection, "AnnotationFilesToEmerald", Annotate)
+    monkeypatch.setattr(modules.WriteOutput, "Outputs", lambda *args: None)
+    rescore.main(["--greed", "0", "--greed", "2", "--score", "0.6", "/tmp/run.gff.checkpoint.npz"])
+    assert calls == ["/tmp/run.gff.checkpoint.npz", (None, 0), (None, 2), (0.6, 1)]
+    assert "/tmp/run.greed2.gff" in capsys.readouterr().out
+
+def testShardsScatterOptions(tmp_path, capsys):
+    from emeraldbgc import shards
+
+    seq = tmp_path / "asm.fna"
+    seq.write_text(">c0\nACGT\n")
+    for opts in [["--meta=False"], ["--meta", "False"], ["--outdir=x"]]:
+        with pytest.raises(SystemExit) as e:
+            shards.main(["scatter", str(seq), "--shards", "2", "--outdir", str(tmp_path / "sc"), "--"] + opts)
+        assert e.value.code == 2
+    shards.main(["scatter", str(seq), "--shards", "2", "--outdir", str(tmp_path / "sc"), "--", "--greed=2"])
+    assert "--greed=2" in (tmp_path / "sc" / "commands.txt").read_text()
@@ -0,0 +1,35 @@
+import subprocess
+import sys
+import pytest
+
+# cumulative import time budgets (microseconds) of the light CLI paths
+IMPORT_BUDGET = {
+    "help": (["-m", "emeraldbgc", "--help"], 1_000_000),
+    "version": (["-m", "emeraldbgc", "--version"], 1_000_000),
+    "build_gb": (["-m", "emeraldbgc.build_gb", "--help"], 1_000_000),
+}
+HEAVY = ["tensorflow", "keras", "joblib", "Bio", "numpy", "scipy"]
+
+
+def importTime(cmd):
+    """(imported modules, total cumulative import time) from python -X importtime"""
+    errs = subprocess.run(
+        [sys.executable, "-X", "importtime"] + cmd, capture_output=True, text=True
+    ).stderr
+    modules, total = [], 0
+    for l in errs.split("\n"):
+        if not l.startswith("import time:") or "cumulative" in l:
+            continue
+        self_us, cumulative, name = l[len("import time:"):].split("|")
+        modules.append(name.strip())
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return modules, total
+
+
+@pytest.mark.parametrize("path", sorted(IMPORT_BUDGET))
+def test_import_time_budget(path):
+    cmd, budget = IMPORT_BUDGET[path]
+    modules, total = importTime(cmd)
+    assert not [m for m in modules if m.split(".")[0] in HEAVY]
+    assert total < budget, f"{path} imports take {total} us, budget {budget} us"
@@ -9,9 +9,11 @@ import subprocess
 emrld_dir = os.path.dirname(os.path.abspath(emeraldbgc.__file__))
 test_files_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
 modules_dir = os.path.join(emrld_dir, "modules")
+sys.path.append(emrld_dir)
 sys.path.append(modules_dir)
 
 from Preproc import Preprocess
+from AnnotationCache import AnnotationCache
 
 def test_prodigal():
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -36,6 +38,10 @@ def test_gbk_transform():
         )
         test_prodigal_file =  pp.gbkToProdigal()
         assert filecmp.cmp(test_prodigal_file, os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.gb.prodigal.faa"))
+        with open(pp.cdsTable) as h:
+            assert [l.split("\t")[1] for l in h] == [l[1:].strip() for l in open(test_prodigal_file) if l[0] == ">"]
+        pp.check_fmt()
+        assert pp.fmt == "genbank"
      
 def test_hmmscan_ih():
     assert subprocess.check_output('hmmscan -h',shell=True)
@@ -44,4 +50,181 @@ def test_ipscan_ih():
     if 'linux' not in sys.platform:
         assert True
     else: 
-        assert subprocess.check_output("interproscan.sh --version",shell=True)
\ No newline at end of file
+        assert subprocess.check_output("interproscan.sh --version",shell=True)
+
+def test_split_fasta():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fasta = os.path.join(tmpdir, "contigs.fna")
+        with open(fasta, "w") as h:
+            for ix, size in enumerate([900, 100, 100, 500, 400, 1000]):
+                h.write(f">contig_{ix}\n{'A' * size}\n")
+        pp = Preprocess(fasta, None, "True", 3, tmpdir)
+        shards = pp.splitFasta(fasta, 3, os.path.join(tmpdir, "shards"))
+        assert [nSeqs for shard, nSeqs in shards] == [2, 3, 1]
+        with open(fasta) as h:
+            ori = h.read()
+        assert "".join(open(shard).read() for shard, nSeqs in shards) == ori
+
+
+def test_annotation_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+        ips_file = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.ip.tsv")
+        cache = AnnotationCache(os.path.join(tmpdir, "cache.db"))
+
+        def run(inFaa, outFile):
+            ids = {l[1:].split()[0] for l in open(inFaa) if l[0] == ">"}
+            with open(outFile, "w") as h:
+                h.writelines(l for l in open(ips_file) if l.split("\t")[0] in ids)
+
+        def fail(inFaa, outFile):
+            raise AssertionError("cached proteins annotated again")
+
+        for func in [run, fail]:
+            out = cache.annotate(
+                "ips", faa, os.path.join(tmpdir, "out.tsv"), func, "\t", 0,
+                os.path.join(tmpdir, "work.faa"), chunk=3,
+            )
+            assert sorted(open(out)) == sorted(open(ips_file))
+
+def test_gbk_to_faa_resume():
+    from StageMarkers import StageMarkers
+
+    gbk = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.gb")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        calls = []
+        def run(resume, force=()):
+            pp = Preprocess(gbk, None, False, 1, tmpdir, markers=StageMarkers(tmpdir, resume, force))
+            pp.gbkToProdigal = lambda f=pp.gbkToProdigal: calls.append(1) or f()
+            pp.check_fmt()
+            pp.cdsTable = f"{pp.faaFile()}.cds.tsv"
+            return pp.resumable("gbk_to_faa", pp.gbkToProdigal, [gbk], lambda: {}, [pp.faaFile(), pp.cdsTable])
+
+        faa = run(False)
+        assert not os.path.exists(os.path.join(tmpdir, "emerald.gbk_to_faa.done"))
+        assert run(True) == faa and len(calls) == 2
+        assert run(True) == faa and len(calls) == 2
+        assert run(True, ["gbk_to_faa"]) == faa and len(calls) == 3
+        with open(faa, "a") as h:
+            h.write(">extra\nM\n")
+        assert run(True) == faa and len(calls) == 4
+        assert filecmp.cmp(faa, os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa.gb.prodigal.faa"))
+
+def test_hmmsearch_shards_layout(monkeypatch):
+    from BGCdetection import AnnotationFilesToEmerald
+
+    faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+    proteins = [l[1:].split()[0] for l in open(faa) if l[0] == ">"]
+    hits = [(p, f"HMM{k}") for ix, p in enumerate(proteins) for k in range(ix % 3)]
+    scores = "- 1e-10 50.0 0.1 1 1 1e-11 1e-10 49.0 0.1 3 120 5 130 1 140 0.95 a profile description"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # canned hmmsearch, hits of the proteins of the shard in hmmsearch's layout
+        tool = os.path.join(tmpdir, "hmmsearch")
+        with open(tool, "w") as h:
+            h.write(f"""#!{sys.executable}
+import sys
+hits = {hits!r}
+out, faa = sys.argv[sys.argv.index("--domtblout") + 1], sys.argv[-1]
+shard = {{l[1:].split()[0] for l in open(faa) if l[0] == ">"}}
+with open(out, "w") as h:
+    h.write("# hmmsearch domtblout\\n")
+    for p, hmm in hits:
+        if p in shard:
+            h.write(f"{{p}} - 400 {{hmm}} PF0000{{hmm[-1]}}.1 200 {scores}\\n")
+""")
+        os.chmod(tool, 0o755)
+        monkeypatch.setenv("PATH", f"{tmpdir}{os.pathsep}{os.environ['PATH']}")
+
+        pp = Preprocess(faa, None, "True", 2, tmpdir, hmmsearch="True")
+        pp.outFaa = faa
+        searchTsv = pp.runHmmScan(cpus=2)
+        scanTsv = os.path.join(tmpdir, "hmmscan.tsv")
+        with open(scanTsv, "w") as h:
+            h.writelines(f"{hmm} PF0000{hmm[-1]}.1 200 {p} - 400 {scores}\n" for p, hmm in hits)
+
+        dcts = []
+        for f in [searchTsv, scanTsv]:
+            ann = AnnotationFilesToEmerald.__new__(AnnotationFilesToEmerald)
+            ann.reset()
+            ann.vocab = {"HMM0": 0, "HMM1": 1}
+            ann.transformEmeraldHmm(f)
+            dcts.append({k: list(v) for k, v in ann.entriesDct.items()})
+    assert dcts[0] and dcts[0] == dcts[1]
+
+def test_failed_tool_not_cached(monkeypatch):
+    faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # hmmsearch writing a partial output and exiting with an error
+        tool = os.path.join(tmpdir, "hmmsearch")
+        with open(tool, "w") as h:
+            h.write(f"""#!{sys.executable}
+import sys
+with open(sys.argv[sys.argv.index("--domtblout") + 1], "w") as h:
+    h.write("# partial\\n")
+sys.exit("Error: out of memory")
+""")
+        os.chmod(tool, 0o755)
+        monkeypatch.setenv("PATH", f"{tmpdir}{os.pathsep}{os.environ['PATH']}")
+
+        pp = Preprocess(faa, None, "True", 1, tmpdir, hmmsearch="True", cache=os.path.join(tmpdir, "cache.db"))
+        with pytest.raises(subprocess.CalledProcessError):
+            pp.cache.annotate(
+                "hmm", faa, os.path.join(tmpdir, "out.tsv"),
+                lambda inFaa, outTsv: pp.runHmmScan(inFaa, outTsv, 1), None, 3,
+                os.path.join(tmpdir, "work.faa"),
+            )
+        proteins = [seqhash for pid, seqhash, seq in pp.cache.hashFasta(faa)]
+        assert pp.cache.get("hmm", set(proteins)) == {}
+
+def test_failed_stage_no_marker():
+    from StageMarkers import StageMarkers
+
+    faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        markers = StageMarkers(tmpdir, resume=True)
+        pp = Preprocess(faa, None, "True", 1, tmpdir, markers=markers)
+        out = os.path.join(tmpdir, "out.tsv")
+
+        def crash():
+            open(out, "w").write("partial\n")
+            raise subprocess.CalledProcessError(1, ["hmmscan"])
+
+        with pytest.raises(subprocess.CalledProcessError):
+            pp.resumable("hmmscan", crash, [faa], lambda: {}, [out])
+        with pytest.raises(SystemExit):
+            pp.resumable("hmmscan", lambda: None, [faa], lambda: {}, [out + ".missing"])
+        assert not os.path.exists(markers.path("hmmscan"))
+
+def test_hmm_cache_key_tool(monkeypatch):
+    faa = os.path.join(test_files_dir, "BGC0001472.fna.prodigal.faa")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr("Preproc.HMM_LIB", faa)
+        keys = []
+        for hmmsearch in ["False", "True"]:
+            pp = Preprocess(faa, None, "True", 1, tmpdir, hmmsearch=hmmsearch, cache=os.path.join(tmpdir, "cache.db"))
+            pp.outFaa = faa
+            pp.toolVersion = lambda cmd, tag: f"# {cmd[0]} 3.3"
+            pp.cache.annotate = lambda tool, *args: keys.append(tool)
+            pp.cachedHmmScan()
+        assert keys[0].startswith("emerald_hmm:hmmscan:# hmmscan 3.3:")
+        assert keys[1].startswith("emerald_hmm:hmmsearch:# hmmsearch 3.3:")
+
+def test_markers_input_check(monkeypatch):
+    from StageMarkers import StageMarkers
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inp, out = os.path.join(tmpdir, "in.fna"), os.path.join(tmpdir, "out.faa")
+        open(inp, "w").write(">c\nACGT\n")
+        open(out, "w").write(">p\nM\n")
+        StageMarkers(tmpdir, resume=True).done("prodigal", [inp], {}, [out])
+
+        markers = StageMarkers(tmpdir, resume=True)
+        monkeypatch.setattr(markers, "md5", lambda path: pytest.fail("input hashed"))
+        assert markers.current("prodigal", [inp], {}, [out])
+        monkeypatch.undo()
+
+        os.utime(inp, ns=(1, 1))
+        assert StageMarkers(tmpdir, resume=True).current("prodigal", [inp], {}, [out])
+        open(inp, "w").write(">c\nACGA\n")
+        os.utime(inp, ns=(1, 1))
+        assert not StageMarkers(tmpdir, resume=True).current("prodigal", [inp], {}, [out])